@@ -0,0 +1,254 @@
+"""
+Sample solution fields at particle positions, to compare the fields with
+the particle properties they represent.
+
+A cell locator is built once for each mesh geometry and reused for all
+timesteps that share this geometry, and the located cells and interpolation
+weights are reused as long as the particles do not move either. Probing a
+field then only takes a weighted sum of its values at the cell vertices.
+"""
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import pyvista as pv
+import vtk
+from tqdm import tqdm
+
+import vtk_io
+
+# Locators built by get_locator, keyed by the geometry hash of the mesh, and
+# the cells and weights found by locate_points. Change the number of kept
+# entries as needed.
+_locators = OrderedDict()
+_located = OrderedDict()
+MAX_LOCATORS = 4
+MAX_LOCATED = 16
+
+
+def _remember(cache,key,value,max_size):
+    """
+    Add an entry to a cache, removing the least recently used entries.
+    """
+    cache[key] = value
+    while len(cache) > max_size:
+        cache.popitem(last=False)
+
+
+def get_locator(mesh):
+    """
+    Get the cell locator of a mesh. Meshes with the same points and cells
+    share a locator.
+
+    The locator is built on a copy of the mesh in which each cell has its
+    own vertices, with a point array that is 1 for the k-th vertex of each
+    cell in component k. Probing this array gives the interpolation weights
+    of the vertices of the cell containing a point.
+
+    Parameters
+    ----------
+    mesh: Pyvista UnstructuredGrid with cells of a single type, e.g. a
+        solution mesh.
+
+    Returns
+    -------
+    locator: Dictionary with the geometry 'key', the cell 'vertices', the
+        'source' mesh and the built VTK 'locator'.
+    """
+    key = vtk_io.geometry_hash(mesh)
+    if key in _locators:
+        _locators.move_to_end(key)
+        return(_locators[key])
+
+    arrays = vtk_io.mesh_to_arrays(mesh)
+    counts = np.diff(arrays['offsets'])
+    if len(counts) == 0 or np.any(counts != counts[0]):
+        raise ValueError("Mesh must contain cells of a single type")
+    n_cells,n_vertices = len(counts),counts[0]
+    vertices = arrays['connectivity'].reshape(n_cells,n_vertices)
+
+    source = vtk_io.arrays_to_mesh([dict(
+        points=arrays['points'][vertices].reshape(-1,3),
+        connectivity=np.arange(n_cells*n_vertices),
+        offsets=arrays['offsets'],
+        celltypes=arrays['celltypes'],
+        point_data=dict(weights=np.tile(np.eye(n_vertices),(n_cells,1))))])
+    # The exploded mesh has n_vertices points per cell, so an array of
+    # length n_cells is added as cell data
+    source['cell_index'] = np.arange(n_cells,dtype=np.int64)
+
+    cell_locator = vtk.vtkStaticCellLocator()
+    cell_locator.SetDataSet(source)
+    cell_locator.BuildLocator()
+
+    locator = dict(key=key,vertices=vertices,source=source,
+                   locator=cell_locator)
+    _remember(_locators,key,locator,MAX_LOCATORS)
+    return(locator)
+
+
+def locate_points(mesh,points):
+    """
+    Find the cells of a mesh that contain each of a set of points, and the
+    interpolation weights of the cell vertices at the points.
+
+    Parameters
+    ----------
+    mesh: Pyvista UnstructuredGrid with cells of a single type.
+    points: NumPy array of point coordinates (X,Y,Z).
+
+    Returns
+    -------
+    cells: NumPy array of cell indices, -1 for points outside the mesh.
+    weights: NumPy array of shape (points,vertices per cell) of the weights
+        of the vertices of each cell.
+    """
+    points = np.ascontiguousarray(points,dtype=float)
+    locator = get_locator(mesh)
+    key = (locator['key'],hashlib.sha1(points.tobytes()).hexdigest())
+    if key in _located:
+        _located.move_to_end(key)
+        return(_located[key])
+
+    n_vertices = locator['vertices'].shape[1]
+    if len(points) == 0:
+        return(np.zeros(0,dtype=np.int64),np.zeros((0,n_vertices)))
+
+    probe = vtk.vtkProbeFilter()
+    probe.SetInputData(pv.PolyData(points))
+    probe.SetSourceData(locator['source'])
+    # The default tolerance is relative to the cell size, which finds points
+    # up to a fraction of a cell outside a neighbouring cell in that cell
+    probe.SetComputeTolerance(False)
+    probe.SetTolerance(1e-9*locator['source'].length)
+    if hasattr(probe,'SetCellLocator'):
+        probe.SetCellLocator(locator['locator'])
+    else:
+        strategy = vtk.vtkCellLocatorStrategy()
+        strategy.SetCellLocator(locator['locator'])
+        probe.SetFindCellStrategy(strategy)
+    probe.Update()
+    output = pv.wrap(probe.GetOutput())
+
+    valid = np.asarray(pv.point_array(output,'vtkValidPointMask')).astype(bool)
+    cells = np.asarray(pv.point_array(output,'cell_index')).astype(np.int64)
+    weights = np.asarray(pv.point_array(output,'weights'),dtype=float)
+    cells[~valid] = -1
+    weights = weights.reshape(len(points),n_vertices)
+
+    _remember(_located,key,(cells,weights),MAX_LOCATED)
+    return(cells,weights)
+
+
+def probe_fields(mesh,points,fields):
+    """
+    Sample point arrays of a mesh at a set of points.
+
+    Parameters
+    ----------
+    mesh: Pyvista UnstructuredGrid with cells of a single type.
+    points: NumPy array of point coordinates (X,Y,Z).
+    fields: List of point arrays of the mesh, e.g. ['ve_stress_xx'].
+
+    Returns
+    -------
+    values: NumPy array of shape (points,fields), NaN for points outside
+        the mesh.
+    """
+    cells,weights = locate_points(mesh,points)
+    inside = cells >= 0
+    rows = get_locator(mesh)['vertices'][cells[inside]]
+
+    values = np.full((len(cells),len(fields)),np.nan)
+    for j,field in enumerate(fields):
+        array = np.asarray(pv.point_array(mesh,field),dtype=float)
+        values[inside,j] = np.einsum('pv,pv->p',array[rows],weights[inside])
+    return(values)
+
+
+def compare_series(solution_files,particle_files,fields,particle_fields=None,
+                   timesteps=None,bounds=None):
+    """
+    Compare solution fields with particle properties at the particle
+    positions for a series of output steps.
+
+    Parameters
+    ----------
+    solution_files: List of solution pvtu files, e.g. from get_pvtu.
+    particle_files: List of particles pvtu files of the same output steps.
+    fields: List of solution fields, e.g. ['ve_stress_xx','ve_stress_xy'].
+    particle_fields: List of particle properties to compare with each field.
+        The default is None, which uses the same names as the fields.
+    timesteps: NumPy array of the timesteps of the files. The default is None,
+        which numbers the files from 0.
+    bounds: Bounds [xmin,xmax,ymin,ymax,zmin,zmax] of the particles to
+        compare. The default is None, which compares all particles.
+
+    Returns
+    -------
+    comparison: Dictionary with the sorted particle 'ids' and the
+        'timesteps', arrays 'fields', 'particles' and 'difference'
+        (particles minus fields) of shape (timesteps,particles,fields) with
+        NaN for particles that do not exist or lie outside the mesh or
+        bounds, and a dictionary 'norms' of arrays of shape (timesteps,fields)
+        with the 'max', 'mean' and 'rms' absolute difference, the number of
+        compared particles 'count' and the 'relative' L2 difference.
+    """
+    if particle_fields is None:
+        particle_fields = fields
+    if timesteps is None:
+        timesteps = np.arange(len(solution_files))
+
+    all_ids = []
+    sampled = []
+    for solution_file,particle_file in tqdm(list(zip(solution_files,
+                                                     particle_files))):
+        mesh = vtk_io.read_vtu(solution_file,fields)
+        particles = vtk_io.read_vtu(particle_file,['id']+list(particle_fields))
+        ids = np.asarray(pv.point_array(particles,'id')).astype(np.int64)
+        positions = np.asarray(particles.points)
+
+        values = np.stack([pv.point_array(particles,field)
+                           for field in particle_fields],axis=1)
+        probed = probe_fields(mesh,positions,fields)
+        if bounds is not None:
+            outside = np.zeros(len(ids),dtype=bool)
+            for d in range(len(bounds)//2):
+                outside |= ((positions[:,d] < bounds[2*d]) |
+                            (positions[:,d] > bounds[2*d+1]))
+            probed[outside] = np.nan
+
+        all_ids.append(ids)
+        sampled.append((ids,values,probed))
+
+    # Scatter all timesteps into arrays over the union of particle ids
+    ids = np.unique(np.concatenate(all_ids))
+    shape = (len(sampled),len(ids),len(fields))
+    field_values = np.full(shape,np.nan)
+    particle_values = np.full(shape,np.nan)
+    for i,(step_ids,values,probed) in enumerate(sampled):
+        columns = np.searchsorted(ids,step_ids)
+        particle_values[i,columns] = values
+        field_values[i,columns] = probed
+    particle_values[np.isnan(field_values)] = np.nan
+    difference = particle_values-field_values
+
+    # Error norms of all timesteps and fields at once. Missing values count
+    # as zero in the sums.
+    missing = np.isnan(difference)
+    absolute = np.where(missing,0.,np.abs(difference))
+    count = np.sum(~missing,axis=1)
+    reference = np.sqrt(np.sum(np.where(missing,0.,field_values)**2,axis=1))
+    l2 = np.sqrt(np.sum(absolute**2,axis=1))
+    with np.errstate(divide='ignore',invalid='ignore'):
+        norms = dict(count=count,
+                     max=np.where(count > 0,absolute.max(axis=1),np.nan),
+                     mean=absolute.sum(axis=1)/count,
+                     rms=l2/np.sqrt(count),
+                     relative=np.where(reference > 0,l2/reference,np.nan))
+    norms['relative'][count == 0] = np.nan
+
+    comparison = dict(ids=ids,timesteps=np.asarray(timesteps),
+                      fields=field_values,particles=particle_values,
+                      difference=difference,norms=norms)
+    return(comparison)
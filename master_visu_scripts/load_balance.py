@@ -0,0 +1,106 @@
+"""
+Load balance of the MPI ranks of a model, from the pieces of its PVTU
+files.
+
+ASPECT writes one VTU piece per MPI rank (unless output is grouped), so the
+number of points and cells in the Piece header of each piece gives the mesh
+cells and particles owned by each rank. Only these headers are read, no
+array data is decoded.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import vtk_io
+
+
+def piece_sizes(files,threads=16):
+    """
+    Get the number of points and cells of each piece of a series of PVTU
+    files. The headers are read on a thread pool, which helps on network
+    file systems.
+
+    Parameters
+    ----------
+    files: List of pvtu files, e.g. from get_pvtu.
+    threads: Number of threads reading headers. The default is 16.
+
+    Returns
+    -------
+    points: NumPy array of shape (files,pieces) of the number of points,
+        padded with zeros if the files have different numbers of pieces.
+    cells: NumPy array of shape (files,pieces) of the number of cells.
+    """
+    pieces = [vtk_io.get_pieces(file) for file in files]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        sizes = list(executor.map(vtk_io.piece_size,
+                                  [piece for file_pieces in pieces
+                                   for piece in file_pieces]))
+
+    n_pieces = max([len(file_pieces) for file_pieces in pieces],default=0)
+    points = np.zeros((len(files),n_pieces),dtype=np.int64)
+    cells = np.zeros((len(files),n_pieces),dtype=np.int64)
+    start = 0
+    for i,file_pieces in enumerate(pieces):
+        size = np.array(sizes[start:start+len(file_pieces)],
+                        dtype=np.int64).reshape(-1,2)
+        points[i,:len(file_pieces)] = size[:,0]
+        cells[i,:len(file_pieces)] = size[:,1]
+        start += len(file_pieces)
+    return(points,cells)
+
+
+def _imbalance(load):
+    """
+    Maximum over mean load of the ranks of each step, 1 for perfect balance.
+    """
+    mean = load.mean(axis=1)
+    return(np.where(mean > 0,load.max(axis=1)/np.where(mean > 0,mean,1),
+                    np.nan))
+
+
+def rank_balance(solution_files,particle_files=None,timesteps=None,
+                 threads=16):
+    """
+    Analyze the load balance of the MPI ranks over a series of output steps.
+
+    Parameters
+    ----------
+    solution_files: List of solution pvtu files, e.g. from get_pvtu.
+    particle_files: List of particles pvtu files of the same output steps.
+        The default is None, which only analyzes the mesh cells.
+    timesteps: NumPy array of the timesteps of the files. The default is None,
+        which numbers the files from 0.
+    threads: Number of threads reading headers. The default is 16.
+
+    Returns
+    -------
+    balance: Dictionary with arrays of shape (timesteps,ranks) of the
+        'cells' and, if particle_files is given, the 'particles' of each
+        rank, and a Pandas DataFrame 'summary' with for each timestep the
+        number of ranks, the mean and maximum load, the imbalance (maximum
+        over mean) and the most loaded rank of the cells and particles.
+    """
+    if timesteps is None:
+        timesteps = np.arange(len(solution_files))
+
+    cells = piece_sizes(solution_files,threads)[1]
+    balance = dict(cells=cells)
+    summary = dict(timestep=np.asarray(timesteps),
+                   ranks=np.full(len(solution_files),cells.shape[1]),
+                   mean_cells=cells.mean(axis=1),
+                   max_cells=cells.max(axis=1),
+                   cell_imbalance=_imbalance(cells),
+                   max_cell_rank=cells.argmax(axis=1))
+
+    if particle_files is not None:
+        particles = piece_sizes(particle_files,threads)[0]
+        balance['particles'] = particles
+        summary.update(mean_particles=particles.mean(axis=1),
+                       max_particles=particles.max(axis=1),
+                       particle_imbalance=_imbalance(particles),
+                       max_particle_rank=particles.argmax(axis=1))
+
+    balance['summary'] = pd.DataFrame(summary)
+    return(balance)
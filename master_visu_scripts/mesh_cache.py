@@ -0,0 +1,233 @@
+"""
+On-disk cache for meshes, rendered images and other data derived from
+VTU/PVTU files.
+
+Cache entries are keyed by the path, modification time and size of the
+source file (and of all its pieces for a PVTU file) together with the
+options used to derive the entry, such as the clip bounds and the requested
+arrays. Changing a source file therefore invalidates its entries, and the
+least recently used entries are removed when the cache grows beyond
+MAX_CACHE_SIZE bytes.
+"""
+import os
+import json
+import hashlib
+
+import numpy as np
+import pyvista as pv
+
+import vtk_io
+
+# Location and maximum size in bytes of the cache, change as needed
+CACHE_DIR = os.environ.get('VTK_PLOT_CACHE',
+                           os.path.join(os.path.expanduser('~'),'.cache',
+                                        'vtk_plot'))
+MAX_CACHE_SIZE = 5e9
+
+
+def file_signature(file):
+    """
+    Get path, modification time and size of a file and of its pieces.
+
+    Parameters
+    ----------
+    file: Path to VTU or PVTU file.
+
+    Returns
+    -------
+    signature: List of [path,mtime,size] for the file and each piece.
+    """
+    files = [file]
+    if file.endswith('.pvtu'):
+        files += vtk_io.get_pieces(file)
+
+    signature = []
+    for f in files:
+        stat = os.stat(f)
+        signature.append([os.path.abspath(f),stat.st_mtime_ns,stat.st_size])
+    return(signature)
+
+
+def _to_json(obj):
+    """
+    Convert NumPy arrays and scalars for json.dumps. Other objects are
+    represented by their repr.
+    """
+    if isinstance(obj,(np.ndarray,np.generic)):
+        return(obj.tolist())
+    return(repr(obj))
+
+
+def cache_key(file,**options):
+    """
+    Create the cache key for data derived from a file.
+
+    Parameters
+    ----------
+    file: Path to VTU or PVTU file, or list of paths.
+    options: Any further options that the cached data depends on, e.g.
+        bounds=[0,100,0,100,0,0]. Values that are not JSON serializable or
+        NumPy arrays are represented by their repr.
+
+    Returns
+    -------
+    key: Hexadecimal SHA-1 digest.
+    """
+    if isinstance(file,str):
+        signature = file_signature(file)
+    else:
+        signature = [file_signature(f) for f in file]
+    content = json.dumps(dict(file=signature,**options),sort_keys=True,
+                         default=_to_json)
+    return(hashlib.sha1(content.encode()).hexdigest())
+
+
+def cache_path(key,extension,cache_dir=None):
+    """
+    Get the path of a cache entry.
+
+    Parameters
+    ----------
+    key: Cache key from cache_key.
+    extension: File extension of the entry, e.g. '.vtu'.
+    cache_dir: Cache directory. The default is None, which uses CACHE_DIR.
+
+    Returns
+    -------
+    path: Path of the cache entry, which may not exist yet.
+    """
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    os.makedirs(cache_dir,exist_ok=True)
+    return(os.path.join(cache_dir,key+extension))
+
+
+def lookup(key,extension,cache_dir=None):
+    """
+    Look up a cache entry and mark it as recently used.
+
+    Returns
+    -------
+    path: Path of the cache entry, or None if the entry does not exist.
+    """
+    path = cache_path(key,extension,cache_dir)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return(None)
+    return(path)
+
+
+def temporary_path(path):
+    """
+    Get a temporary path with the same extension as path. Entries are
+    written to a temporary path first and then moved into place, so that
+    other processes never read half-written entries.
+    """
+    root,extension = os.path.splitext(path)
+    return(root+'.'+str(os.getpid())+'.tmp'+extension)
+
+
+def evict(cache_dir=None,max_size=None):
+    """
+    Remove the least recently used cache entries until the cache is smaller
+    than max_size bytes.
+
+    Parameters
+    ----------
+    cache_dir: Cache directory. The default is None, which uses CACHE_DIR.
+    max_size: Maximum cache size in bytes. The default is None, which uses
+        MAX_CACHE_SIZE.
+    """
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    if max_size is None:
+        max_size = MAX_CACHE_SIZE
+    if not os.path.isdir(cache_dir):
+        return
+
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file():
+            stat = entry.stat()
+            entries.append((stat.st_mtime,stat.st_size,entry.path))
+
+    total = sum(entry[1] for entry in entries)
+    for mtime,size,path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def load_meshes(files,bounds=None,arrays=None,processes=None,cache_dir=None,
+                max_size=None,progress=True):
+    """
+    Load clipped meshes from the cache, reading and clipping only the files
+    that are not cached yet or that have changed since they were cached.
+
+    Parameters
+    ----------
+    files: List of paths to VTU or PVTU files.
+    bounds: Bounds by which to clip the meshes [xmin,xmax,ymin,ymax,zmin,zmax].
+        The default is None.
+    arrays: List of point arrays to read, all other arrays are skipped when
+        reading the files. The default is None, which reads all arrays.
+    processes: Number of worker processes used to read the files. The
+        default is None, which uses the number of CPUs.
+    cache_dir: Cache directory. The default is None, which uses CACHE_DIR.
+    max_size: Maximum cache size in bytes. The default is None, which uses
+        MAX_CACHE_SIZE.
+    progress: Whether to show a progress bar while reading. The default is
+        True.
+
+    Returns
+    -------
+    meshes: List of Pyvista meshes, one for each file.
+    """
+    if arrays is not None:
+        arrays = sorted(set(arrays))
+
+    keys = [cache_key(file,kind='mesh',bounds=bounds,arrays=arrays)
+            for file in files]
+
+    # Load cached meshes
+    meshes = [None]*len(files)
+    missing = []
+    for i,key in enumerate(keys):
+        path = lookup(key,'.vtu',cache_dir)
+        if path is None:
+            missing.append(i)
+        else:
+            meshes[i] = pv.read(path)
+
+    # Read, clip and cache the remaining meshes
+    if len(missing) > 0:
+        new_meshes = vtk_io.read_pvtu_parallel([files[i] for i in missing],
+                                               bounds=bounds,
+                                               processes=processes,
+                                               arrays=arrays,
+                                               progress=progress)
+        for i,mesh in zip(missing,new_meshes):
+            path = cache_path(keys[i],'.vtu',cache_dir)
+            tmp = temporary_path(path)
+            mesh.save(tmp)
+            os.replace(tmp,path)
+            meshes[i] = mesh
+        evict(cache_dir,max_size)
+
+    return(meshes)
+
+
+def load_mesh(file,bounds=None,arrays=None,processes=1,cache_dir=None,
+              max_size=None,progress=True):
+    """
+    Load a single clipped mesh from the cache. See load_meshes. The default
+    processes=1 reads the file in this process, without a process pool.
+    """
+    return(load_meshes([file],bounds=bounds,arrays=arrays,processes=processes,
+                       cache_dir=cache_dir,max_size=max_size,
+                       progress=progress)[0])
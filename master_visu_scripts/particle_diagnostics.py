@@ -0,0 +1,176 @@
+"""
+Diagnostics of the distribution of particles over the cells of the mesh:
+the number of particles per cell and the spread of particle properties
+within each cell, for a series of output steps.
+
+The output steps are processed in a process pool. Each worker keeps the
+cell locator of field_probe, so that it is built only once per mesh
+geometry. The cells are those of the output file. Output with
+'Interpolate output = true' splits each ASPECT cell into 2^dim output cells,
+which the subdivisions parameter merges back as in
+particle_interpolation.py, so that the counts compare with the 'Minimum
+particles per cell' and 'Maximum particles per cell' of the model.
+"""
+import numpy as np
+import pyvista as pv
+from tqdm import tqdm
+
+import field_probe
+import particle_interpolation
+import vtk_io
+
+
+def cell_statistics(mesh,positions,values,subdivisions=1):
+    """
+    Count the particles in each cell of a mesh and compute the spread of
+    their properties.
+
+    Parameters
+    ----------
+    mesh: Pyvista UnstructuredGrid with cells of a single type.
+    positions: NumPy array of particle positions (X,Y,Z).
+    values: NumPy array of shape (particles,properties).
+    subdivisions: Number of output cells per ASPECT cell in each dimension,
+        see particle_interpolation.interpolate_particles. The default is 1,
+        which uses the output cells, as needed for 'Write higher order
+        output'. Other values raise a ValueError for higher order cells.
+
+    Returns
+    -------
+    statistics: Dictionary with the number of particles per (ASPECT) cell
+        'count',
+        the number of particles outside the mesh 'outside', and arrays 'min',
+        'max', 'mean' and 'std' of shape (cells,properties), NaN for empty
+        cells.
+    """
+    block = particle_interpolation.subdivision_block(mesh,subdivisions)
+    values = np.asarray(values,dtype=float).reshape(len(positions),-1)
+    cells,weights = field_probe.locate_points(mesh,positions)
+    inside = cells >= 0
+    cells = cells[inside]//block
+    values = values[inside]
+
+    n_cells = mesh.n_cells//block
+    count = np.bincount(cells,minlength=n_cells)
+    statistics = dict(count=count,outside=int(np.sum(~inside)))
+
+    shape = (n_cells,values.shape[1])
+    for name in ['min','max','mean','std']:
+        statistics[name] = np.full(shape,np.nan)
+    if len(cells) == 0:
+        return(statistics)
+
+    # Mean and standard deviation, in two passes to avoid cancellation for
+    # large stresses with a small spread
+    full = count > 0
+    for j in range(values.shape[1]):
+        mean = (np.bincount(cells,weights=values[:,j],minlength=n_cells)
+                /np.maximum(count,1))
+        squares = np.bincount(cells,weights=(values[:,j]-mean[cells])**2,
+                              minlength=n_cells)
+        statistics['mean'][full,j] = mean[full]
+        statistics['std'][full,j] = np.sqrt(squares[full]/count[full])
+
+    # Sort by cell for the minimum and maximum of each cell
+    order = np.argsort(cells,kind='stable')
+    starts = np.searchsorted(cells[order],np.flatnonzero(full))
+    statistics['min'][full] = np.minimum.reduceat(values[order],starts,axis=0)
+    statistics['max'][full] = np.maximum.reduceat(values[order],starts,axis=0)
+    return(statistics)
+
+
+def _diagnose_step(job):
+    """
+    Compute the cell statistics of one output step. Runs in a worker
+    process.
+    """
+    solution_file,particle_file,fields,subdivisions = job
+    mesh = vtk_io.read_vtu(solution_file,arrays=[])
+    particles = vtk_io.read_vtu(particle_file,arrays=fields)
+    values = np.column_stack([np.asarray(pv.point_array(particles,field),
+                                         dtype=float)
+                              for field in fields])
+    return(cell_statistics(mesh,np.asarray(particles.points),values,
+                           subdivisions))
+
+
+def diagnose_series(solution_files,particle_files,
+                    fields=['ve_stress_xx','ve_stress_yy','ve_stress_xy'],
+                    min_particles=None,max_particles=None,timesteps=None,
+                    subdivisions=1,processes=None):
+    """
+    Compute particle distribution diagnostics for a series of output steps.
+
+    Parameters
+    ----------
+    solution_files: List of solution pvtu files, e.g. from get_pvtu.
+    particle_files: List of particles pvtu files of the same output steps.
+    fields: List of particle properties for which to compute the spread per
+        cell. The default is the stress components.
+    min_particles: Cells with fewer particles are counted as underfull, e.g.
+        the 'Minimum particles per cell' of the model. The default is None,
+        which only counts empty cells.
+    max_particles: Cells with more particles are counted as overfull, e.g.
+        the 'Maximum particles per cell' of the model. The default is None.
+    timesteps: NumPy array of the timesteps of the files. The default is None,
+        which numbers the files from 0.
+    subdivisions: Number of output cells per ASPECT cell in each dimension,
+        see cell_statistics. The default is 1.
+    processes: Number of worker processes. The default is None, which uses
+        the number of CPUs. Use 1 to run serially.
+
+    Returns
+    -------
+    diagnostics: Dictionary with, for each output step,
+        'timesteps',
+        'histogram': array of shape (timesteps,maximum count+1) of the
+            number of cells with 0, 1, 2, ... particles,
+        'empty', 'underfull', 'overfull', 'outside': arrays of the number
+            of empty, underfull and overfull cells and of particles outside
+            the mesh,
+        'min_count', 'max_count', 'mean_count': arrays of particles per cell,
+        'cells': list of the cell_statistics of each step, with per-cell
+            arrays that may differ in length if the mesh is adapted,
+        'spread': array of shape (timesteps,fields) of the mean over the
+            cells of the per-cell standard deviation of each property.
+    """
+    if timesteps is None:
+        timesteps = np.arange(len(solution_files))
+    jobs = [(solution_file,particle_file,list(fields),subdivisions)
+            for solution_file,particle_file in zip(solution_files,
+                                                   particle_files)]
+
+    if processes == 1:
+        cells = [_diagnose_step(job) for job in tqdm(jobs)]
+    else:
+        with vtk_io.process_pool(processes) as pool:
+            cells = list(tqdm(pool.map(_diagnose_step,jobs),total=len(jobs)))
+
+    counts = [step['count'] for step in cells]
+    histogram = np.zeros((len(cells),max(count.max(initial=0)
+                                         for count in counts)+1),dtype=int)
+    for i,count in enumerate(counts):
+        histogram[i,:count.max(initial=0)+1] = np.bincount(count)
+
+    if min_particles is None:
+        min_particles = 1
+    diagnostics = dict(
+        timesteps=np.asarray(timesteps),
+        histogram=histogram,
+        empty=np.array([np.sum(count == 0) for count in counts]),
+        underfull=np.array([np.sum(count < min_particles)
+                            for count in counts]),
+        overfull=np.array([0 if max_particles is None
+                           else np.sum(count > max_particles)
+                           for count in counts]),
+        outside=np.array([step['outside'] for step in cells]),
+        min_count=np.array([count.min(initial=0) for count in counts]),
+        max_count=np.array([count.max(initial=0) for count in counts]),
+        mean_count=np.array([count.mean() if len(count) > 0 else np.nan
+                             for count in counts]),
+        cells=cells,
+        spread=np.array([np.nanmean(step['std'],axis=0)
+                         if np.any(step['count'] > 0)
+                         else np.full(len(fields),np.nan)
+                         for step in cells]))
+    return(diagnostics)
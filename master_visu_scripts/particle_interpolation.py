@@ -0,0 +1,340 @@
+"""
+Offline interpolation of particle properties onto the solution mesh,
+following the particle interpolators of ASPECT.
+
+The interpolation schemes are those of the ASPECT parameter
+'Interpolation scheme': cell_average, nearest_neighbor,
+distance_weighted_average, bilinear_least_squares and
+quadratic_least_squares. Each cell of the mesh is interpolated only from
+the particles inside it, and the values are evaluated at the vertices of
+the cell. Vertices shared by several cells get the mean of their values.
+
+The particles of all cells are gathered into a padded array of shape
+(cells,particles per cell), so that all schemes are evaluated for many cells
+at once, and the least-squares systems of all cells are solved together.
+
+Note that the cells are those of the output file. When ASPECT writes output
+with 'Interpolate output = true', each cell is split into 2^dim output cells
+that each contain fewer particles than the cell used by ASPECT. deal.II
+writes these output cells consecutively, so with subdivisions=2 each block
+of 2^dim consecutive cells is merged back into the cell used by ASPECT.
+With 'Write higher order output = true', as in the models of this
+repository, each ASPECT cell is written as one Lagrange cell instead, and
+subdivisions must be 1.
+"""
+import numpy as np
+import pyvista as pv
+
+import field_probe
+import vtk_io
+
+SCHEMES = ['cell_average','nearest_neighbor','distance_weighted_average',
+           'bilinear_least_squares','quadratic_least_squares']
+
+# Dimension of the linear cells written by ASPECT without higher order output
+LINEAR_CELLS = {9:2,12:3} # VTK_QUAD, VTK_HEXAHEDRON
+
+
+def locate_cells(mesh,points):
+    """
+    Find the cells of a mesh that contain each of a set of points. The cell
+    locator of the mesh is cached, see field_probe.locate_points.
+
+    Parameters
+    ----------
+    mesh: Pyvista mesh, e.g. a solution mesh.
+    points: NumPy array of point coordinates (X,Y,Z).
+
+    Returns
+    -------
+    cells: NumPy array of cell indices, -1 for points outside the mesh.
+    """
+    if mesh.n_cells == 0:
+        return(np.full(len(points),-1,dtype=np.int64))
+    return(field_probe.locate_points(mesh,points)[0])
+
+
+def cell_vertices(mesh):
+    """
+    Get the vertices of each cell of a mesh with a single cell type, e.g. the
+    quadrilaterals or hexahedra written by ASPECT.
+
+    Returns
+    -------
+    vertices: NumPy array of shape (cells,vertices per cell) of point indices.
+    """
+    arrays = vtk_io.mesh_to_arrays(mesh)
+    counts = np.diff(arrays['offsets'])
+    if len(counts) == 0 or np.any(counts != counts[0]):
+        raise ValueError("Mesh must contain cells of a single type")
+    return(arrays['connectivity'].reshape(len(counts),counts[0]))
+
+
+def subdivision_block(mesh,subdivisions):
+    """
+    Number of consecutive output cells that make up one ASPECT cell.
+
+    Parameters
+    ----------
+    mesh: Pyvista UnstructuredGrid written by ASPECT.
+    subdivisions: Number of output cells per ASPECT cell in each dimension,
+        2 for 'Interpolate output = true' without 'Write higher order
+        output', 1 otherwise.
+
+    Returns
+    -------
+    block: subdivisions^dim.
+    """
+    if subdivisions == 1:
+        return(1)
+    celltypes = np.unique(np.asarray(mesh.celltypes))
+    if len(celltypes) != 1 or int(celltypes[0]) not in LINEAR_CELLS:
+        raise ValueError("subdivisions > 1 requires linear quadrilaterals or "
+                         "hexahedra, higher order output has one cell per "
+                         "ASPECT cell")
+    block = subdivisions**LINEAR_CELLS[int(celltypes[0])]
+    if mesh.n_cells % block != 0:
+        raise ValueError("Number of cells is not a multiple of "+str(block))
+    return(block)
+
+
+def group_particles(cells,n_cells):
+    """
+    Group particles by the cell that contains them.
+
+    Parameters
+    ----------
+    cells: NumPy array of the cell of each particle, from locate_cells.
+        Particles with cell -1 are ignored.
+    n_cells: Number of cells of the mesh.
+
+    Returns
+    -------
+    slots: NumPy array of shape (cells,maximum particles per cell) of
+        particle indices, padded with -1.
+    """
+    inside = np.flatnonzero(cells >= 0)
+    order = inside[np.argsort(cells[inside],kind='stable')]
+    sorted_cells = cells[order]
+    counts = np.bincount(sorted_cells,minlength=n_cells)
+    starts = np.concatenate([[0],np.cumsum(counts)[:-1]])
+
+    # Position of each particle within its cell
+    rank = np.arange(len(order))-starts[sorted_cells]
+    slots = np.full((n_cells,max(counts.max(initial=0),1)),-1,dtype=np.int64)
+    slots[sorted_cells,rank] = order
+    return(slots)
+
+
+def _basis(x,scheme):
+    """
+    Polynomial basis of the least-squares schemes at the normalized
+    coordinates x of shape (...,dim).
+    """
+    dim = x.shape[-1]
+    terms = [np.ones(x.shape[:-1])]+[x[...,d] for d in range(dim)]
+    if scheme == 'quadratic_least_squares':
+        for d in range(dim):
+            for e in range(d,dim):
+                terms.append(x[...,d]*x[...,e])
+    return(np.stack(terms,axis=-1))
+
+
+def _interpolate_cells(x_particles,values,mask,x_vertices,scheme,limiter):
+    """
+    Interpolate a chunk of cells. Coordinates are normalized to [-1,1] in
+    each cell.
+
+    Parameters
+    ----------
+    x_particles: Array of shape (cells,particles,dim).
+    values: Array of shape (cells,particles).
+    mask: Boolean array of shape (cells,particles) of the existing particles.
+    x_vertices: Array of shape (cells,vertices,dim).
+
+    Returns
+    -------
+    result: Array of shape (cells,vertices), NaN for cells without particles.
+    """
+    count = mask.sum(axis=1)
+    values = np.where(mask,values,0.)
+
+    if scheme == 'cell_average':
+        average = values.sum(axis=1)/np.maximum(count,1)
+        result = np.repeat(average[:,None],x_vertices.shape[1],axis=1)
+
+    elif scheme in ['nearest_neighbor','distance_weighted_average']:
+        distance = np.linalg.norm(x_vertices[:,:,None,:]
+                                  -x_particles[:,None,:,:],axis=-1)
+        if scheme == 'nearest_neighbor':
+            distance[~np.broadcast_to(mask[:,None,:],distance.shape)] = np.inf
+            nearest = np.argmin(distance,axis=2)
+            result = np.take_along_axis(values,nearest,axis=1)
+        else:
+            # Hat function of the distance, with the cell diagonal as width
+            dim = x_vertices.shape[-1]
+            weights = np.maximum(1.-distance/(2.*np.sqrt(dim)),0.)
+            weights = weights*mask[:,None,:]
+            total = weights.sum(axis=2)
+            result = ((weights*values[:,None,:]).sum(axis=2)
+                      /np.where(total > 0,total,1.))
+
+    elif scheme in ['bilinear_least_squares','quadratic_least_squares']:
+        # Normal equations of all cells at once, missing particles have
+        # zero rows. The pseudo-inverse also handles cells with fewer
+        # particles than coefficients.
+        matrix = _basis(x_particles,scheme)*mask[:,:,None]
+        normal = np.einsum('cpi,cpj->cij',matrix,matrix)
+        rhs = np.einsum('cpi,cp->ci',matrix,values)
+        coefficients = np.einsum('cij,cj->ci',np.linalg.pinv(normal),rhs)
+        result = np.einsum('cvi,ci->cv',_basis(x_vertices,scheme),
+                           coefficients)
+        if limiter:
+            # Keep the values within the range of the particles of the cell
+            low = np.where(mask,values,np.inf).min(axis=1)
+            high = np.where(mask,values,-np.inf).max(axis=1)
+            result = np.clip(result,low[:,None],high[:,None])
+
+    else:
+        raise ValueError("Unknown interpolation scheme "+scheme)
+
+    result[count == 0] = np.nan
+    return(result)
+
+
+def interpolate_particles(mesh,positions,values,scheme,limiter=True,
+                          subdivisions=1,chunk_size=100000):
+    """
+    Interpolate particle properties onto the points of a mesh.
+
+    Parameters
+    ----------
+    mesh: Pyvista mesh with cells of a single type, e.g. a solution mesh.
+    positions: NumPy array of particle positions (X,Y,Z).
+    values: NumPy array of particle properties, of shape (particles,) or
+        (particles,properties).
+    scheme: Interpolation scheme, one of SCHEMES.
+    limiter: Whether to limit the least-squares schemes to the range of the
+        particle values in each cell, like ASPECT's 'Use linear least squares
+        limiter' and 'Use quadratic least squares limiter'. The default is
+        True.
+    subdivisions: Number of output cells per ASPECT cell in each dimension,
+        2 for output written with 'Interpolate output = true' and without
+        'Write higher order output'. Each block of subdivisions^dim
+        consecutive cells is then interpolated as one cell, with the
+        particles and at the points of all its output cells. Use 1 for
+        higher order output, which has one Lagrange cell per ASPECT cell;
+        other values then raise a ValueError. The default is 1, which
+        interpolates each output cell.
+    chunk_size: Approximate number of particles interpolated at once, which
+        limits the memory used. The default is 100000.
+
+    Returns
+    -------
+    result: NumPy array of the interpolated properties at the mesh points,
+        of shape (points,) or (points,properties). Points of cells without
+        particles get NaN.
+    """
+    if scheme not in SCHEMES:
+        raise ValueError("Unknown interpolation scheme "+scheme)
+    block = subdivision_block(mesh,subdivisions)
+    positions = np.asarray(positions,dtype=float)
+    values = np.asarray(values,dtype=float)
+    single = values.ndim == 1
+    values = values.reshape(len(values),-1)
+
+    points = np.asarray(mesh.points,dtype=float)
+    vertices = cell_vertices(mesh)
+    cells = locate_cells(mesh,positions)
+
+    # Normalize coordinates to [-1,1] in each cell. Dimensions without extent
+    # (e.g. z in 2D) are left out.
+    active = np.ptp(points,axis=0) > 0
+    points = points[:,active]
+    positions = positions[:,active]
+
+    # Merge the output cells of each ASPECT cell. Points shared by its output
+    # cells are evaluated once, the repeated ones are skipped.
+    repeated = np.zeros(vertices.shape,dtype=bool)
+    if block > 1:
+        vertices = np.sort(vertices.reshape(-1,block*vertices.shape[1]),
+                           axis=1)
+        repeated = np.zeros(vertices.shape,dtype=bool)
+        repeated[:,1:] = vertices[:,1:] == vertices[:,:-1]
+        cells = np.where(cells >= 0,cells//block,-1)
+    n_cells = len(vertices)
+    slots = group_particles(cells,n_cells)
+
+    # Number of cells per chunk
+    step = max(chunk_size//slots.shape[1],1)
+
+    total = np.zeros((len(points),values.shape[1]))
+    weight = np.zeros((len(points),values.shape[1]))
+    for start in range(0,n_cells,step):
+        cell_points = points[vertices[start:start+step]]
+        lower = cell_points.min(axis=1,keepdims=True)
+        upper = cell_points.max(axis=1,keepdims=True)
+        center = (lower+upper)/2
+        half = np.where(upper > lower,(upper-lower)/2,1.)
+
+        chunk = slots[start:start+step]
+        mask = chunk >= 0
+        x_particles = (positions[np.maximum(chunk,0)]-center)/half
+        x_vertices = (cell_points-center)/half
+
+        for j in range(values.shape[1]):
+            result = _interpolate_cells(x_particles,values[chunk,j],mask,
+                                        x_vertices,scheme,limiter)
+            valid = ~np.isnan(result) & ~repeated[start:start+step]
+            index = vertices[start:start+step][valid]
+            total[:,j] += np.bincount(index,weights=result[valid],
+                                      minlength=len(points))
+            weight[:,j] += np.bincount(index,minlength=len(points))
+
+    result = np.full(total.shape,np.nan)
+    np.divide(total,weight,out=result,where=weight > 0)
+    if single:
+        return(result[:,0])
+    return(result)
+
+
+def interpolate_file(solution_file,particle_file,fields,schemes=SCHEMES,
+                     limiter=True,subdivisions=1,arrays=None):
+    """
+    Interpolate the particle properties of an output step with several
+    schemes, for comparison with the fields of the same step.
+
+    Parameters
+    ----------
+    solution_file: Path to solution pvtu file.
+    particle_file: Path to particles pvtu file of the same output step.
+    fields: List of particle properties to interpolate, e.g.
+        ['ve_stress_xx','ve_stress_yy','ve_stress_xy'].
+    schemes: List of interpolation schemes. The default is all SCHEMES.
+    limiter: Whether to limit the least-squares schemes, see
+        interpolate_particles. The default is True.
+    subdivisions: Number of output cells per ASPECT cell in each dimension,
+        see interpolate_particles. The default is 1.
+    arrays: List of solution fields to read along with the mesh. The default
+        is None, which reads the fields with the same names as the particle
+        properties.
+
+    Returns
+    -------
+    mesh: Pyvista mesh of the solution with the solution fields and, for each
+        property and scheme, a point array named <property>_<scheme>.
+    """
+    if arrays is None:
+        arrays = fields
+    mesh = vtk_io.read_vtu(solution_file,arrays)
+    particles = vtk_io.read_vtu(particle_file,fields)
+    values = np.stack([pv.point_array(particles,field) for field in fields],
+                      axis=1)
+
+    for scheme in schemes:
+        result = interpolate_particles(mesh,particles.points,values,scheme,
+                                       limiter=limiter,
+                                       subdivisions=subdivisions)
+        for j,field in enumerate(fields):
+            mesh[field+'_'+scheme] = result[:,j]
+    return(mesh)
@@ -0,0 +1,447 @@
+"""
+Memory-mapped store of particle properties over time.
+
+A series of particle PVTU files is converted once into a directory holding
+one NumPy .npy file per particle property, laid out as
+(timestep, particle) or (timestep, particle, component), together with the
+sorted particle ids and an index.json file. The .npy files are opened as
+memory maps, so that particle traces and positions only read the slices
+they need instead of parsing the VTU files again.
+
+join_histories writes the complementary layout (particle, timestep,
+property) for the time histories of all particles. It sorts each timestep by
+id and merges the sorted timesteps in chunks of ids, so that its memory use
+depends on the chunk size and not on the number of particles.
+"""
+import os
+import json
+
+import numpy as np
+import pyvista as pv
+from tqdm import tqdm
+
+import vtk_io
+
+
+def convert_particles(files,store,timesteps=None,fields=None,bounds=None,
+                      processes=None):
+    """
+    Convert a series of particle PVTU files into a particle store.
+
+    Each file is read once. Its ids and properties are first written to
+    temporary files, so that only a single timestep is held in memory.
+    Particles that do not exist in a timestep (or lie outside the bounds)
+    get NaN values.
+
+    Parameters
+    ----------
+    files: List of particle pvtu files, e.g. from get_pvtu(kind='particles').
+    store: Path to directory to write the store to.
+    timesteps: NumPy array of the timesteps of the files. The default is None,
+        which numbers the files from 0.
+    fields: List of particle properties to store, other properties are not
+        read. The default is None, which stores all properties except id.
+    bounds: Bounds by which to clip the particles
+        [xmin,xmax,ymin,ymax,zmin,zmax]. The default is None.
+    processes: Number of worker processes used to read the files. The
+        default is None, which uses the number of CPUs.
+
+    Returns
+    -------
+    store: Path to the store directory.
+    """
+    if timesteps is None:
+        timesteps = np.arange(len(files))
+    os.makedirs(store,exist_ok=True)
+
+    # Read each timestep once and keep its arrays on disk
+    all_ids = []
+    dtypes = {}
+    components = {}
+    for i,file in enumerate(tqdm(files)):
+        if fields is None:
+            arrays = None
+        else:
+            arrays = ['id']+list(fields)
+        mesh = vtk_io.read_pvtu_parallel(file,bounds=bounds,
+                                         processes=processes,arrays=arrays)
+        if fields is None:
+            fields = [name for name in vtk_io.point_array_names(mesh)
+                      if name != 'id']
+        ids = pv.point_array(mesh,'id').astype(np.int64)
+        np.save(os.path.join(store,'tmp_%05d_id.npy' % i),ids)
+        all_ids.append(np.unique(ids))
+        for field in fields:
+            array = np.asarray(pv.point_array(mesh,field))
+            np.save(os.path.join(store,'tmp_%05d_%s.npy' % (i,field)),array)
+            dtypes[field] = np.promote_types(array.dtype,np.float32)
+            components[field] = array.shape[1:]
+
+    # All particle ids that exist in any timestep
+    ids = np.unique(np.concatenate(all_ids))
+    np.save(os.path.join(store,'id.npy'),ids)
+
+    # Scatter each timestep into the memory maps
+    arrays = {}
+    for field in fields:
+        arrays[field] = np.lib.format.open_memmap(
+            os.path.join(store,field+'.npy'),mode='w+',dtype=dtypes[field],
+            shape=(len(files),len(ids))+components[field])
+        arrays[field][:] = np.nan
+
+    for i in range(len(files)):
+        tmp = os.path.join(store,'tmp_%05d_id.npy' % i)
+        columns = np.searchsorted(ids,np.load(tmp))
+        os.remove(tmp)
+        for field in fields:
+            tmp = os.path.join(store,'tmp_%05d_%s.npy' % (i,field))
+            arrays[field][i,columns] = np.load(tmp)
+            os.remove(tmp)
+
+    for field in fields:
+        arrays[field].flush()
+
+    index = dict(files=[os.path.abspath(file) for file in files],
+                 timesteps=np.asarray(timesteps).tolist(),
+                 fields=fields,
+                 bounds=None if bounds is None else list(bounds))
+    with open(os.path.join(store,'index.json'),'w') as f:
+        json.dump(index,f,indent=1)
+
+    return(store)
+
+
+def open_store(store):
+    """
+    Open a particle store created by convert_particles.
+
+    Parameters
+    ----------
+    store: Path to the store directory.
+
+    Returns
+    -------
+    particles: Dictionary with the sorted particle 'ids', the 'timesteps'
+        and a dictionary 'fields' of read-only memory maps, one for each
+        particle property.
+    """
+    with open(os.path.join(store,'index.json')) as f:
+        index = json.load(f)
+
+    particles = dict(ids=np.load(os.path.join(store,'id.npy')),
+                     timesteps=np.array(index['timesteps']),
+                     fields={field:np.load(os.path.join(store,field+'.npy'),
+                                           mmap_mode='r')
+                             for field in index['fields']})
+    return(particles)
+
+
+def _rows(particles,timesteps):
+    """
+    Rows of the store belonging to the given timesteps.
+    """
+    rows = np.searchsorted(particles['timesteps'],timesteps)
+    rows = np.minimum(rows,len(particles['timesteps'])-1)
+    if not np.all(particles['timesteps'][rows]==timesteps):
+        raise ValueError("Not all timesteps are in the particle store")
+    return(rows)
+
+
+def _in_bounds(positions,bounds):
+    """
+    Mask of positions inside bounds [xmin,xmax,ymin,ymax,zmin,zmax].
+    """
+    inside = np.ones(positions.shape[:-1],dtype=bool)
+    for d in range(len(bounds)//2):
+        inside &= ((positions[...,d] >= bounds[2*d]) &
+                   (positions[...,d] <= bounds[2*d+1]))
+    return(inside)
+
+
+def store_traces(particles,timesteps,points,fields,bounds=None):
+    """
+    Get the paths of particles from a particle store. Same as
+    vtk_plot.particle_traces, but only the required slices are read.
+
+    Parameters
+    ----------
+    particles: Particle store opened with open_store.
+    timesteps: NumPy array of timesteps to pull
+    points: NumPy array of IDs of particles to trace
+    fields: List of particle properties. Use 'x', 'y' and 'z' for the
+        components of the particle position.
+    bounds: List of bounds [xmin,xmax,ymin,ymax,zmin,zmax]. Particles outside
+        the bounds get NaN values. The default is None.
+
+    Returns
+    -------
+    values: NumPy array of shape (timesteps,points,fields).
+    """
+    timesteps = np.atleast_1d(timesteps)
+    points = np.atleast_1d(points).astype(np.int64)
+    rows = _rows(particles,timesteps)
+
+    # Columns of the particles, missing particles get NaN
+    ids = particles['ids']
+    columns = np.minimum(np.searchsorted(ids,points),len(ids)-1)
+    found = ids[columns]==points
+    columns = columns[found]
+
+    components = {'x':0,'y':1,'z':2}
+    values = np.full((len(timesteps),len(points),len(fields)),np.nan)
+    for j,field in enumerate(fields):
+        if field in components:
+            array = particles['fields']['position'][:,:,components[field]]
+        else:
+            array = particles['fields'][field]
+        values[:,found,j] = array[np.ix_(rows,columns)]
+
+    if bounds is not None:
+        positions = particles['fields']['position'][np.ix_(rows,columns)]
+        outside = np.ones((len(timesteps),len(points)),dtype=bool)
+        outside[:,found] = ~_in_bounds(positions,bounds)
+        values[outside] = np.nan
+
+    return(values)
+
+
+def store_positions(particles,timestep,bounds=None):
+    """
+    Get ids and positions of all particles in a particular timestep from a
+    particle store.
+
+    Returns
+    -------
+    ids: NumPy array of particle ids
+    positions: NumPy array of particle positions (X,Y,Z)
+    """
+    row = _rows(particles,np.atleast_1d(timestep))[0]
+    positions = np.asarray(particles['fields']['position'][row])
+
+    # Particles that exist in this timestep
+    inside = ~np.isnan(positions[:,0])
+    if bounds is not None:
+        inside &= _in_bounds(positions,bounds)
+    return(particles['ids'][inside],positions[inside])
+
+
+def _property_names(field,components):
+    """
+    Names of the components of a particle property in a history store.
+    """
+    if field == 'position':
+        return(['x','y','z'][:max(components,1)])
+    if components <= 1:
+        return([field])
+    return([field+'_'+str(c) for c in range(components)])
+
+
+def _merge_bounds(runs,chunk_size):
+    """
+    Split sorted id runs into chunks of ids. Each chunk ends before the id
+    that is chunk_size places further in the run that reaches it first, so
+    that no run contributes more than chunk_size ids to a chunk.
+
+    Yields
+    ------
+    slices: List of (start,end) of each run in the chunk.
+    """
+    cursors = [0]*len(runs)
+    while any(cursor < len(run) for cursor,run in zip(cursors,runs)):
+        ends = [run[cursor+chunk_size] for cursor,run in zip(cursors,runs)
+                if cursor+chunk_size < len(run)]
+        if len(ends) == 0:
+            slices = [(cursor,len(run)) for cursor,run in zip(cursors,runs)]
+        else:
+            upper = min(ends)
+            slices = [(cursor,int(np.searchsorted(run,upper)))
+                      for cursor,run in zip(cursors,runs)]
+        yield(slices)
+        cursors = [end for start,end in slices]
+
+
+def join_histories(files,store,timesteps=None,fields=None,bounds=None,
+                   chunk_size=100000,processes=None):
+    """
+    Join the particles of a series of particle PVTU files on their id into a
+    store of the time histories of all particles.
+
+    Each file is read once, sorted by id and written to temporary files. The
+    sorted timesteps are then merged in chunks of ids, and each chunk of
+    histories is written to a memory map of shape (particles,timesteps,
+    properties). Particles created or removed during the model get NaN
+    values in the timesteps in which they do not exist.
+
+    Parameters
+    ----------
+    files: List of particle pvtu files, e.g. from get_pvtu(kind='particles').
+    store: Path to directory to write the store to.
+    timesteps: NumPy array of the timesteps of the files. The default is None,
+        which numbers the files from 0.
+    fields: List of particle properties to store, e.g.
+        ['position','ve_stress_xx']. The default is None, which stores all
+        properties except id.
+    bounds: Bounds by which to clip the particles
+        [xmin,xmax,ymin,ymax,zmin,zmax]. The default is None.
+    chunk_size: Number of particles per timestep merged at once. The default
+        is 100000.
+    processes: Number of worker processes used to read the files. The
+        default is None, which uses the number of CPUs.
+
+    Returns
+    -------
+    store: Path to the store directory.
+    """
+    if timesteps is None:
+        timesteps = np.arange(len(files))
+    os.makedirs(store,exist_ok=True)
+
+    # Sort each timestep by id and keep it on disk
+    properties = None
+    dtype = np.float32
+    for i,file in enumerate(tqdm(files)):
+        if fields is None:
+            arrays = None
+        else:
+            arrays = ['id']+list(fields)
+        mesh = vtk_io.read_pvtu_parallel(file,bounds=bounds,
+                                         processes=processes,arrays=arrays)
+        if fields is None:
+            fields = [name for name in vtk_io.point_array_names(mesh)
+                      if name != 'id']
+        ids = pv.point_array(mesh,'id').astype(np.int64)
+        order = np.argsort(ids,kind='stable')
+
+        columns = []
+        names = []
+        for field in fields:
+            array = np.asarray(pv.point_array(mesh,field))
+            array = array.reshape(len(ids),-1)
+            columns.append(array[order])
+            names += _property_names(field,array.shape[1])
+            dtype = np.promote_types(dtype,array.dtype)
+        if properties is None:
+            properties = names
+        elif names != properties:
+            raise ValueError("Particle properties differ between timesteps")
+
+        np.save(os.path.join(store,'tmp_%05d_id.npy' % i),ids[order])
+        np.save(os.path.join(store,'tmp_%05d_values.npy' % i),
+                np.concatenate(columns,axis=1))
+
+    runs = [np.load(os.path.join(store,'tmp_%05d_id.npy' % i),mmap_mode='r')
+            for i in range(len(files))]
+    values = [np.load(os.path.join(store,'tmp_%05d_values.npy' % i),
+                      mmap_mode='r')
+              for i in range(len(files))]
+
+    # Count the particles to size the memory maps
+    n_particles = 0
+    for slices in _merge_bounds(runs,chunk_size):
+        n_particles += len(np.unique(np.concatenate(
+            [run[start:end] for run,(start,end) in zip(runs,slices)])))
+
+    shape = (n_particles,len(files),len(properties))
+    history = np.lib.format.open_memmap(os.path.join(store,'history.npy'),
+                                        mode='w+',dtype=dtype,shape=shape)
+    all_ids = np.lib.format.open_memmap(os.path.join(store,'id.npy'),
+                                        mode='w+',dtype=np.int64,
+                                        shape=(n_particles,))
+    first = np.lib.format.open_memmap(os.path.join(store,'first.npy'),
+                                      mode='w+',dtype=np.int32,
+                                      shape=(n_particles,))
+    last = np.lib.format.open_memmap(os.path.join(store,'last.npy'),
+                                     mode='w+',dtype=np.int32,
+                                     shape=(n_particles,))
+
+    # Merge the timesteps one chunk of ids at a time
+    row = 0
+    for slices in _merge_bounds(runs,chunk_size):
+        ids = np.unique(np.concatenate(
+            [run[start:end] for run,(start,end) in zip(runs,slices)]))
+        block = np.full((len(ids),len(files),len(properties)),np.nan,
+                        dtype=dtype)
+        exists = np.zeros((len(ids),len(files)),dtype=bool)
+        for i,(start,end) in enumerate(slices):
+            rows = np.searchsorted(ids,runs[i][start:end])
+            block[rows,i] = values[i][start:end]
+            exists[rows,i] = True
+
+        history[row:row+len(ids)] = block
+        all_ids[row:row+len(ids)] = ids
+        first[row:row+len(ids)] = np.argmax(exists,axis=1)
+        last[row:row+len(ids)] = len(files)-1-np.argmax(exists[:,::-1],axis=1)
+        row += len(ids)
+
+    for array in [history,all_ids,first,last]:
+        array.flush()
+    del runs,values
+    for i in range(len(files)):
+        os.remove(os.path.join(store,'tmp_%05d_id.npy' % i))
+        os.remove(os.path.join(store,'tmp_%05d_values.npy' % i))
+
+    index = dict(files=[os.path.abspath(file) for file in files],
+                 timesteps=np.asarray(timesteps).tolist(),
+                 fields=fields,
+                 properties=properties,
+                 bounds=None if bounds is None else list(bounds))
+    with open(os.path.join(store,'history.json'),'w') as f:
+        json.dump(index,f,indent=1)
+
+    return(store)
+
+
+def open_histories(store):
+    """
+    Open a history store created by join_histories.
+
+    Returns
+    -------
+    histories: Dictionary with the sorted particle 'ids', the 'timesteps',
+        the 'properties', the read-only memory map 'history' of shape
+        (particles,timesteps,properties), and the timestep indices 'first'
+        and 'last' in which each particle exists.
+    """
+    with open(os.path.join(store,'history.json')) as f:
+        index = json.load(f)
+
+    histories = dict(ids=np.load(os.path.join(store,'id.npy'),mmap_mode='r'),
+                     timesteps=np.array(index['timesteps']),
+                     properties=index['properties'],
+                     history=np.load(os.path.join(store,'history.npy'),
+                                     mmap_mode='r'),
+                     first=np.load(os.path.join(store,'first.npy'),
+                                   mmap_mode='r'),
+                     last=np.load(os.path.join(store,'last.npy'),
+                                  mmap_mode='r'))
+    return(histories)
+
+
+def particle_histories(histories,points,properties):
+    """
+    Get the time histories of particles from a history store.
+
+    Parameters
+    ----------
+    histories: History store opened with open_histories.
+    points: NumPy array of IDs of particles.
+    properties: List of properties, e.g. ['x','y','ve_stress_xx'].
+
+    Returns
+    -------
+    values: NumPy array of shape (points,timesteps,properties), NaN for
+        particles that do not exist.
+    """
+    points = np.atleast_1d(points).astype(np.int64)
+    ids = histories['ids']
+    rows = np.minimum(np.searchsorted(ids,points),len(ids)-1)
+    found = np.asarray(ids[rows]) == points
+    columns = [histories['properties'].index(name) for name in properties]
+
+    values = np.full((len(points),len(histories['timesteps']),
+                      len(properties)),np.nan)
+    # Memory maps are read in sorted row order
+    order = np.argsort(rows[found])
+    selected = np.asarray(histories['history'][rows[found][order]])
+    values[np.flatnonzero(found)[order]] = selected[:,:,columns]
+    return(values)
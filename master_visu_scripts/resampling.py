@@ -0,0 +1,198 @@
+"""
+Resample solution fields from (adaptively refined) meshes onto common
+target points, such as a uniform grid, a line or a surface, to compare runs
+with different meshes.
+
+For each distinct mesh geometry a sparse matrix is built once that maps the
+values at the mesh points to the values at the target points. The matrix is
+cached in memory and on disk (see mesh_cache.py), keyed by the hashes of the
+mesh geometry and of the target points, so that resampling a field is a
+single sparse matrix-vector product.
+"""
+import os
+import json
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import pyvista as pv
+from scipy import sparse
+
+import field_probe
+import mesh_cache
+import vtk_io
+
+# Operators built by get_operator. Change the number of kept operators as
+# needed.
+_operators = OrderedDict()
+MAX_OPERATORS = 8
+
+
+def grid_points(bounds,shape):
+    """
+    Get the points of a uniform grid. Use a single point in a dimension for
+    a surface, e.g. shape (200,100,1) for a horizontal slice.
+
+    Parameters
+    ----------
+    bounds: Bounds of the grid [xmin,xmax,ymin,ymax,zmin,zmax].
+    shape: Number of points in each dimension (nx,ny,nz).
+
+    Returns
+    -------
+    points: NumPy array of shape (nx*ny*nz,3), with x varying fastest like
+        a VTK image.
+    """
+    axes = [np.linspace(bounds[2*d],bounds[2*d+1],shape[d]) if shape[d] > 1
+            else np.array([(bounds[2*d]+bounds[2*d+1])/2.])
+            for d in range(3)]
+    z,y,x = np.meshgrid(axes[2],axes[1],axes[0],indexing='ij')
+    return(np.column_stack([x.ravel(),y.ravel(),z.ravel()]))
+
+
+def line_points(start,end,n):
+    """
+    Get n equally spaced points on the line from start to end (X,Y,Z).
+    """
+    fraction = np.linspace(0,1,n)[:,None]
+    start = np.asarray(start,dtype=float)
+    return(start+fraction*(np.asarray(end,dtype=float)-start))
+
+
+def _key(geometry,points):
+    """
+    Cache key of the operator from a mesh geometry to target points.
+    """
+    content = json.dumps(dict(kind='resampling',geometry=geometry,
+                              points=hashlib.sha1(points.tobytes()).hexdigest()))
+    return(hashlib.sha1(content.encode()).hexdigest())
+
+
+def build_operator(mesh,points):
+    """
+    Build the interpolation matrix from the points of a mesh to target
+    points, with the linear interpolation weights of the cell containing
+    each target point.
+
+    Parameters
+    ----------
+    mesh: Pyvista UnstructuredGrid with cells of a single type.
+    points: NumPy array of target coordinates (X,Y,Z).
+
+    Returns
+    -------
+    operator: Dictionary with the sparse 'matrix' of shape
+        (targets,mesh points) and the boolean array 'valid' of the targets
+        inside the mesh.
+    """
+    points = np.ascontiguousarray(points,dtype=float)
+    cells,weights = field_probe.locate_points(mesh,points)
+    valid = cells >= 0
+
+    vertices = field_probe.get_locator(mesh)['vertices'][cells[valid]]
+    rows = np.repeat(np.flatnonzero(valid),vertices.shape[1])
+    matrix = sparse.csr_matrix((weights[valid].ravel(),
+                                (rows,vertices.ravel())),
+                               shape=(len(points),mesh.n_points))
+    return(dict(matrix=matrix,valid=valid))
+
+
+def get_operator(mesh,points,cache_dir=None):
+    """
+    Get the interpolation matrix from a mesh to target points, building it
+    only if it is neither in memory nor in the cache directory.
+
+    Parameters
+    ----------
+    mesh: Pyvista UnstructuredGrid with cells of a single type.
+    points: NumPy array of target coordinates (X,Y,Z), e.g. from grid_points
+        or line_points.
+    cache_dir: Cache directory. The default is None, which uses
+        mesh_cache.CACHE_DIR.
+
+    Returns
+    -------
+    operator: Operator from build_operator.
+    """
+    points = np.ascontiguousarray(points,dtype=float)
+    key = _key(vtk_io.geometry_hash(mesh),points)
+    if key in _operators:
+        _operators.move_to_end(key)
+        return(_operators[key])
+
+    path = mesh_cache.lookup(key,'.npz',cache_dir)
+    if path is not None:
+        with np.load(path) as data:
+            matrix = sparse.csr_matrix((data['data'],data['indices'],
+                                        data['indptr']),
+                                       shape=tuple(data['shape']))
+            operator = dict(matrix=matrix,valid=data['valid'])
+    else:
+        operator = build_operator(mesh,points)
+        matrix = operator['matrix']
+        path = mesh_cache.cache_path(key,'.npz',cache_dir)
+        tmp = mesh_cache.temporary_path(path)
+        np.savez(tmp,data=matrix.data,indices=matrix.indices,
+                 indptr=matrix.indptr,shape=np.array(matrix.shape),
+                 valid=operator['valid'])
+        os.replace(tmp,path)
+        mesh_cache.evict(cache_dir)
+
+    _operators[key] = operator
+    while len(_operators) > MAX_OPERATORS:
+        _operators.popitem(last=False)
+    return(operator)
+
+
+def resample(mesh,fields,points,cache_dir=None):
+    """
+    Resample point arrays of a mesh at target points.
+
+    Parameters
+    ----------
+    mesh: Pyvista UnstructuredGrid with cells of a single type.
+    fields: List of point arrays, e.g. ['T','ve_stress_xx'].
+    points: NumPy array of target coordinates (X,Y,Z).
+    cache_dir: Cache directory for the operator. The default is None, which
+        uses mesh_cache.CACHE_DIR.
+
+    Returns
+    -------
+    values: NumPy array of shape (targets,fields), NaN for targets outside
+        the mesh.
+    """
+    operator = get_operator(mesh,points,cache_dir)
+    columns = np.column_stack([np.asarray(pv.point_array(mesh,field),
+                                          dtype=float)
+                               for field in fields])
+    values = operator['matrix']@columns
+    values[~operator['valid']] = np.nan
+    return(values)
+
+
+def resample_series(files,fields,points,reuse_geometry=True,cache_dir=None):
+    """
+    Resample point arrays of a series of output steps at target points.
+    Only the requested fields are read, and steps with the same mesh share
+    one operator.
+
+    Parameters
+    ----------
+    files: List of solution pvtu files, e.g. from get_pvtu.
+    fields: List of point arrays, e.g. ['T','ve_stress_xx'].
+    points: NumPy array of target coordinates (X,Y,Z).
+    reuse_geometry: Whether to reuse unchanged geometry when reading, see
+        vtk_io.read_series. The default is True.
+    cache_dir: Cache directory for the operators. The default is None, which
+        uses mesh_cache.CACHE_DIR.
+
+    Returns
+    -------
+    values: NumPy array of shape (files,targets,fields). Reshape to
+        (files,nz,ny,nx,fields) for points from grid_points.
+    """
+    values = np.full((len(files),len(points),len(fields)),np.nan)
+    for i,mesh in enumerate(vtk_io.read_series(files,arrays=fields,
+                                               reuse_geometry=reuse_geometry)):
+        values[i] = resample(mesh,fields,points,cache_dir)
+    return(values)
@@ -0,0 +1,284 @@
+"""
+Decode the model parameters from the names of run directories, and keep an
+index of the runs in a directory tree that can be queried.
+
+The run directory names encode the configuration of a model, e.g.
+RL9_viscoelastic_bending_beam_htansmooth10m_particles_Newton_diffminmaxPPC_
+fieldpropRR_main_avegeometric_intbilinear_least_squares_limTrue_dtc250_
+dte250_IGR2_IAR1_np4, where an optional suffix _1 numbers repeated runs.
+
+The index is an SQLite file with one row per run directory (a directory with
+a statistics file) holding the decoded parameters and the size, modification
+time and last time step of the statistics file. Scanning only rereads the
+statistics of runs that changed, so scripts can select runs with a query
+instead of lists of names.
+"""
+import os
+import re
+import sqlite3
+
+import pandas as pd
+
+import mesh_cache
+
+INTERPOLATORS = ['cell_average','nearest_neighbor','bilinear_least_squares',
+                 'quadratic_least_squares','distance_weighted_average',
+                 'harmonic_average']
+
+# Abbreviations of the interpolators in run names
+ABBREVIATIONS = {'CA':'cell_average','NN':'nearest_neighbor',
+                 'BLS':'bilinear_least_squares',
+                 'QLS':'quadratic_least_squares',
+                 'DWA':'distance_weighted_average'}
+
+SOLVERS = ['Newton','Picard','AMG','GMG']
+
+# Decoded parameters and their SQLite types
+PARAMETERS = {'RL':'INTEGER','particles':'INTEGER','solver':'TEXT',
+              'PPC':'TEXT','averaging':'TEXT','interpolator':'TEXT',
+              'limiter':'INTEGER','dtc':'REAL','dte':'REAL','GR':'INTEGER',
+              'IGR':'INTEGER','IAR':'INTEGER','np':'INTEGER',
+              'repeat':'INTEGER'}
+
+# Columns of the index besides the parameters
+COLUMNS = {'path':'TEXT PRIMARY KEY','name':'TEXT','size':'INTEGER',
+           'mtime':'INTEGER','steps':'INTEGER','time':'REAL'}
+
+
+def _number(text):
+    """
+    Convert a number in a run name to int or float, e.g. '2_5' to 2.5.
+    """
+    text = text.replace('_','.')
+    return(float(text) if '.' in text else int(text))
+
+
+def decode_name(name):
+    """
+    Decode the model parameters from a run directory name.
+
+    Parameters
+    ----------
+    name: Run directory name, with or without the path.
+
+    Returns
+    -------
+    parameters: Dictionary with the keys of PARAMETERS: the refinement level
+        'RL', whether the run uses 'particles', the 'solver' (e.g. 'Newton'
+        or 'Newton_AMG'), the 'PPC' (particles per cell) setting, the
+        viscosity 'averaging', the particle 'interpolator' and 'limiter', the
+        computational and elastic time steps 'dtc' and 'dte', the global and
+        initial global and adaptive refinement 'GR', 'IGR' and 'IAR', the
+        number of processes 'np' and the 'repeat' number. Parameters that are
+        not in the name are None.
+    """
+    name = os.path.basename(os.path.normpath(name))
+    tokens = name.split('_')
+    parameters = dict.fromkeys(PARAMETERS)
+
+    match = re.match(r'RL(\d+)(?:_|$)',name)
+    if match is not None:
+        parameters['RL'] = int(match.group(1))
+    parameters['particles'] = 'particles' in tokens
+    solvers = [token for token in tokens if token in SOLVERS]
+    if len(solvers) > 0:
+        parameters['solver'] = '_'.join(solvers)
+    match = re.search(r'(?:^|_)([A-Za-z]*)PPC(?:_|$)',name)
+    if match is not None:
+        parameters['PPC'] = match.group(1)
+
+    # 'average' is part of interpolator names, so it is not an averaging
+    match = re.search(r'(?:^|_)(?:averaging|ave)(?!rage)'
+                      r'([a-z]+(?:_composition)?)',name)
+    if match is not None:
+        parameters['averaging'] = match.group(1)
+    match = re.search(r'(?:^|_)(?:int|interpolator)('
+                      +'|'.join(INTERPOLATORS)+')',name)
+    if match is not None:
+        parameters['interpolator'] = match.group(1)
+    else:
+        match = re.search(r'(?:^|_)('+'|'.join(ABBREVIATIONS)
+                          +r')(lim)?(?:_|$)',name)
+        if match is not None:
+            parameters['interpolator'] = ABBREVIATIONS[match.group(1)]
+            if match.group(2) is not None:
+                parameters['limiter'] = True
+    match = re.search(r'(?:^|_)lim(True|False)(?:_|$)',name)
+    if match is not None:
+        parameters['limiter'] = match.group(1) == 'True'
+
+    # Time steps such as dtc2.5 or dtc2_5
+    end = 0
+    for key in ['dtc','dte']:
+        match = re.search(r'(?:^|_)'+key+r'(\d[._]\d+|\d+(?:\.\d+)?)(?=_|$)',
+                          name)
+        if match is not None:
+            parameters[key] = _number(match.group(1))
+            end = max(end,match.end())
+    for key in ['GR','IGR','IAR','np']:
+        match = re.search(r'(?:^|_)'+key+r'(\d+)(?:_|$)',name)
+        if match is not None:
+            parameters[key] = int(match.group(1))
+
+    match = re.search(r'_(\d+)$',name)
+    if match is not None and match.start() >= end:
+        parameters['repeat'] = int(match.group(1))
+    return(parameters)
+
+
+def connect(database=None):
+    """
+    Open the index, creating it if needed.
+
+    Parameters
+    ----------
+    database: Path of the SQLite file. The default is None, which uses
+        index/run_index.sqlite in mesh_cache.CACHE_DIR. It is kept in a
+        subdirectory, so that mesh_cache.evict does not remove it.
+
+    Returns
+    -------
+    connection: sqlite3 Connection.
+    """
+    if database is None:
+        directory = os.path.join(mesh_cache.CACHE_DIR,'index')
+        os.makedirs(directory,exist_ok=True)
+        database = os.path.join(directory,'run_index.sqlite')
+    connection = sqlite3.connect(database)
+    columns = dict(COLUMNS,**PARAMETERS)
+    connection.execute('CREATE TABLE IF NOT EXISTS runs ('
+                       +','.join(name+' '+kind
+                                 for name,kind in columns.items())+')')
+    return(connection)
+
+
+def find_runs(root,file='statistics'):
+    """
+    Find the run directories in a directory tree, i.e. the directories with
+    a statistics file. The output directories of runs are not searched.
+
+    Returns
+    -------
+    runs: List of paths of run directories.
+    """
+    runs = []
+    directories = [root]
+    while len(directories) > 0:
+        directory = directories.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except (PermissionError,FileNotFoundError):
+            continue
+        if any(entry.name == file and entry.is_file() for entry in entries):
+            runs.append(directory)
+            continue
+        directories.extend(entry.path for entry in entries
+                           if entry.is_dir(follow_symlinks=False))
+    return(sorted(runs))
+
+
+def _last_row(file,size,block=65536):
+    """
+    Get the time step number and time of the last complete row of a
+    statistics file, reading only its end.
+    """
+    with open(file,'rb') as f:
+        f.seek(max(size-block,0))
+        lines = f.read(size-max(size-block,0)).split(b'\n')[:-1]
+    for line in reversed(lines):
+        values = line.split()
+        if len(values) >= 2 and not line.startswith(b'#'):
+            try:
+                return(int(float(values[0])),float(values[1]))
+            except ValueError:
+                continue
+    return(None,None)
+
+
+def scan(root,database=None,file='statistics'):
+    """
+    Add the runs in a directory tree to the index, and remove runs that no
+    longer exist. Runs whose statistics file has the same size and
+    modification time as in the index are not read again.
+
+    Parameters
+    ----------
+    root: Directory tree with run directories, e.g. a scratch directory.
+    database: Path of the SQLite file, see connect.
+    file: Name of the statistics file. The default is 'statistics'.
+
+    Returns
+    -------
+    n_updated: Number of runs that were added or updated.
+    """
+    root = os.path.abspath(root)
+    connection = connect(database)
+    prefix = os.path.join(root,'')
+    known = {path:(size,mtime) for path,size,mtime in connection.execute(
+        'SELECT path,size,mtime FROM runs WHERE substr(path,1,?) = ?',
+        (len(prefix),prefix))}
+
+    rows = []
+    runs = find_runs(root,file)
+    for run in runs:
+        stat = os.stat(os.path.join(run,file))
+        if known.get(run) == (stat.st_size,stat.st_mtime_ns):
+            continue
+        steps,time = _last_row(os.path.join(run,file),stat.st_size)
+        row = dict(path=run,name=os.path.basename(run),size=stat.st_size,
+                   mtime=stat.st_mtime_ns,steps=steps,time=time)
+        row.update(decode_name(run))
+        rows.append(row)
+
+    columns = list(COLUMNS)+list(PARAMETERS)
+    with connection:
+        connection.executemany('INSERT OR REPLACE INTO runs ('
+                               +','.join(columns)+') VALUES ('
+                               +','.join('?'*len(columns))+')',
+                               [[row[column] for column in columns]
+                                for row in rows])
+        connection.executemany('DELETE FROM runs WHERE path = ?',
+                               [(path,) for path in set(known)-set(runs)])
+    connection.close()
+    return(len(rows))
+
+
+def query(where=None,arguments=(),database=None,**equal):
+    """
+    Select runs from the index.
+
+    Parameters
+    ----------
+    where: SQL condition, e.g. "dtc = dte AND interpolator LIKE '%least%'".
+        The default is None, which selects all runs.
+    arguments: Values of ? placeholders in where.
+    database: Path of the SQLite file, see connect.
+    equal: Parameters the runs must have, e.g. interpolator='cell_average',
+        np=4.
+
+    Returns
+    -------
+    runs: Pandas DataFrame with a row per run, sorted by path. Pass
+        list(runs['path']) to e.g. statistics_io.load_runs.
+    """
+    conditions = [] if where is None else ['('+where+')']
+    arguments = list(arguments)
+    for key,value in equal.items():
+        if key not in PARAMETERS and key not in COLUMNS:
+            raise KeyError("Unknown parameter "+key)
+        if value is None:
+            conditions.append(key+' IS NULL')
+        else:
+            conditions.append(key+' = ?')
+            arguments.append(value)
+
+    sql = 'SELECT * FROM runs'
+    if len(conditions) > 0:
+        sql += ' WHERE '+' AND '.join(conditions)
+    connection = connect(database)
+    runs = pd.read_sql_query(sql+' ORDER BY path',connection,
+                             params=arguments)
+    connection.close()
+    for key in ['particles','limiter']:
+        runs[key] = runs[key].map({1:True,0:False})
+    return(runs)
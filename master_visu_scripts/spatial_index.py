@@ -0,0 +1,190 @@
+"""
+Spatial index for bounding-box and neighbourhood queries on point clouds,
+such as the particles of one timestep.
+
+Points are sorted into uniform grid bins for box queries, and a KD-tree is
+built on demand for radius and k-nearest-neighbour queries. All queries
+return index arrays into the original points, so selecting points does not
+create new VTK geometry like mesh.clip_box does.
+"""
+from collections import OrderedDict
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Indices built by get_index, keyed by the VTK object and its modification
+# time. Change the number of kept indices as needed.
+_indices = OrderedDict()
+MAX_INDICES = 16
+
+
+def build_index(points,points_per_bin=8):
+    """
+    Build a spatial index of points.
+
+    Parameters
+    ----------
+    points: NumPy array of point coordinates (X,Y,Z).
+    points_per_bin: Average number of points per grid bin. The default is 8.
+
+    Returns
+    -------
+    index: Dictionary with the points, the grid of bins and the point order
+        sorted by bin.
+    """
+    points = np.asarray(points,dtype=float)
+    if len(points) == 0:
+        points = np.zeros((0,3))
+        lower = np.zeros(3)
+        upper = np.zeros(3)
+    else:
+        lower = points.min(axis=0)
+        upper = points.max(axis=0)
+
+    # Bin size such that each bin holds points_per_bin points on average.
+    # Dimensions with an extent smaller than a bin (e.g. z in 2D, or noise
+    # around a plane) get a single bin, so the bin size is recomputed for the
+    # remaining dimensions. This keeps the number of bins below
+    # 2**dimensions*n_bins.
+    extent = upper-lower
+    active = extent > 0
+    n_bins = max(len(points)//points_per_bin,1)
+    bin_size = 1.
+    while active.any():
+        bin_size = (np.prod(extent[active])/n_bins)**(1./active.sum())
+        if np.all(extent[active] >= bin_size):
+            break
+        active &= extent >= bin_size
+    shape = np.where(active,np.ceil(extent/bin_size),1).astype(int)
+    shape = np.maximum(shape,1)
+
+    cells = np.floor((points-lower)/bin_size).astype(int)
+    cells = np.minimum(np.maximum(cells,0),shape-1)
+    bins = np.ravel_multi_index(cells.T,shape)
+
+    order = np.argsort(bins,kind='stable')
+    starts = np.searchsorted(bins[order],np.arange(np.prod(shape)+1))
+
+    index = dict(points=points,lower=lower,upper=upper,bin_size=bin_size,
+                 shape=shape,order=order,starts=starts,tree=None)
+    return(index)
+
+
+def get_index(mesh,points_per_bin=8):
+    """
+    Get the spatial index of the points of a Pyvista mesh. The index is built
+    once and reused until the mesh is modified.
+
+    Parameters
+    ----------
+    mesh: Pyvista mesh, e.g. one block of load_particle_meshes.
+    points_per_bin: Average number of points per grid bin. The default is 8.
+
+    Returns
+    -------
+    index: Spatial index from build_index.
+    """
+    key = (mesh.__this__,mesh.GetMTime(),points_per_bin)
+    if key in _indices:
+        _indices.move_to_end(key)
+        return(_indices[key])
+
+    index = build_index(mesh.points,points_per_bin)
+    _indices[key] = index
+    while len(_indices) > MAX_INDICES:
+        _indices.popitem(last=False)
+    return(index)
+
+
+def query_box(index,bounds):
+    """
+    Find the points inside a box.
+
+    Parameters
+    ----------
+    index: Spatial index from build_index or get_index.
+    bounds: List of bounds [xmin,xmax,ymin,ymax] or
+        [xmin,xmax,ymin,ymax,zmin,zmax]. Points on the bounds are inside.
+
+    Returns
+    -------
+    rows: Sorted NumPy array of the indices of the points inside the box.
+    """
+    bounds = np.asarray(bounds,dtype=float)
+    lo = np.full(3,-np.inf)
+    hi = np.full(3,np.inf)
+    lo[:len(bounds)//2] = bounds[0::2]
+    hi[:len(bounds)//2] = bounds[1::2]
+
+    if (len(index['points']) == 0 or np.any(hi < index['lower'])
+            or np.any(lo > index['upper'])):
+        return(np.zeros(0,dtype=int))
+
+    # Range of bins overlapping the box in each dimension
+    shape = index['shape']
+    lo_cell = np.floor((np.maximum(lo,index['lower'])-index['lower'])
+                       /index['bin_size'])
+    hi_cell = np.floor((np.minimum(hi,index['upper'])-index['lower'])
+                       /index['bin_size'])
+    lo_cell = np.clip(lo_cell,0,shape-1).astype(int)
+    hi_cell = np.clip(hi_cell,0,shape-1).astype(int)
+    grid = np.meshgrid(*[np.arange(lo_cell[d],hi_cell[d]+1) for d in range(3)],
+                       indexing='ij')
+    bins = np.ravel_multi_index([g.ravel() for g in grid],shape)
+
+    # Gather the points of all these bins
+    begin = index['starts'][bins]
+    counts = index['starts'][bins+1]-begin
+    offsets = np.repeat(begin-np.cumsum(counts)+counts,counts)
+    candidates = index['order'][offsets+np.arange(counts.sum())]
+
+    points = index['points'][candidates]
+    inside = np.all((points >= lo) & (points <= hi),axis=1)
+    return(np.sort(candidates[inside]))
+
+
+def _tree(index):
+    """
+    KD-tree of an index, built on first use.
+    """
+    if index['tree'] is None:
+        index['tree'] = cKDTree(index['points'])
+    return(index['tree'])
+
+
+def query_radius(index,center,radius):
+    """
+    Find the points within a distance of a point.
+
+    Parameters
+    ----------
+    index: Spatial index from build_index or get_index.
+    center: Coordinates (X,Y,Z) of the center.
+    radius: Distance from the center.
+
+    Returns
+    -------
+    rows: Sorted NumPy array of the indices of the points within radius.
+    """
+    rows = _tree(index).query_ball_point(np.asarray(center,dtype=float),radius)
+    return(np.sort(np.array(rows,dtype=int)))
+
+
+def query_nearest(index,points,k=1):
+    """
+    Find the k nearest points of each of a set of query points.
+
+    Parameters
+    ----------
+    index: Spatial index from build_index or get_index.
+    points: NumPy array of query coordinates (X,Y,Z).
+    k: Number of neighbours. The default is 1.
+
+    Returns
+    -------
+    distances: NumPy array of shape (points,k) of the distances.
+    rows: NumPy array of shape (points,k) of the indices of the neighbours.
+    """
+    points = np.atleast_2d(np.asarray(points,dtype=float))
+    distances,rows = _tree(index).query(points,k=k)
+    return(distances.reshape(len(points),k),rows.reshape(len(points),k))
@@ -0,0 +1,559 @@
+"""
+Functions for reading the statistics files written by ASPECT.
+
+ASPECT writes a header of lines '# N: <name>' naming each column, followed
+by one row of numbers per time step. The header is parsed to map the column
+names to columns, so that scripts can ask for e.g. 'Time (years)' instead of
+counting columns, which differ between models with and without particles.
+The numbers are decoded in a single pass by NumPy instead of line by line.
+
+load_statistics keeps the parsed columns in the cache directory of
+mesh_cache.py as one .npy file per column, which are opened as memory maps
+until the statistics file changes. When a running model has only added rows,
+just the new rows are parsed.
+
+load_runs reads the statistics of many runs on a thread pool into one table
+with a row per time step of each run, so that runs can be compared with
+grouped operations instead of loops over runs.
+
+follow_statistics watches the statistics files of running models and yields
+only the rows added since the last poll, reading each file from where the
+previous poll stopped.
+"""
+import io
+import os
+import re
+import glob
+import json
+import time
+import asyncio
+import hashlib
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import mesh_cache
+
+# Header line '# N: name'
+HEADER = re.compile(r'^#\s*(\d+):\s*(.*?)\s*$')
+
+
+def parse_header(lines):
+    """
+    Get the column names from the header lines of a statistics file.
+
+    Parameters
+    ----------
+    lines: List of header lines, starting with '#'.
+
+    Returns
+    -------
+    names: List of column names in column order.
+    """
+    columns = {}
+    for line in lines:
+        match = HEADER.match(line)
+        if match is not None:
+            columns[int(match.group(1))-1] = match.group(2)
+    names = [columns.get(i,'Column '+str(i+1))
+             for i in range(max(columns,default=-1)+1)]
+    return(names)
+
+
+def split_header(text):
+    """
+    Split the text of a statistics file into its header lines and body.
+
+    Returns
+    -------
+    header: List of header lines.
+    body: Text of the rows, up to and including the last complete line.
+    """
+    header = []
+    position = 0
+    while text.startswith('#',position):
+        end = text.find('\n',position)
+        if end < 0:
+            end = len(text)
+        header.append(text[position:end])
+        position = end+1
+
+    # Leave out an incomplete last line of a running model
+    end = text.rfind('\n')+1
+    if end < position:
+        return(header,'')
+    return(header,text[position:end])
+
+
+def _is_number(text):
+    """
+    Whether a value of a statistics file is a number.
+    """
+    try:
+        float(text)
+    except ValueError:
+        return(False)
+    return(True)
+
+
+def parse_body(body,n_columns):
+    """
+    Decode the rows of a statistics file.
+
+    Parameters
+    ----------
+    body: Text of complete rows, see split_header.
+    n_columns: Number of columns.
+
+    Returns
+    -------
+    data: NumPy array of shape (rows,columns), NaN for missing values and
+        text such as file names.
+    """
+    if not body.strip():
+        return(np.zeros((0,n_columns)))
+
+    # NumPy 1 warns and NumPy 2 raises on text such as file names
+    with warnings.catch_warnings():
+        warnings.simplefilter('error',DeprecationWarning)
+        try:
+            values = np.fromstring(body,sep=' ')
+        except (ValueError,DeprecationWarning):
+            values = None
+    if values is not None and n_columns > 0 and (
+            values.size % n_columns == 0
+            and values.size//n_columns == body.count('\n')):
+        return(values.reshape(-1,n_columns))
+
+    # Text columns, such as the 'Visualization file name' and 'Particle file
+    # name', are NaN. They are found from the first row and not parsed.
+    first = next((line.split() for line in io.StringIO(body)
+                  if line.strip() and not line.lstrip().startswith('#')),[])
+    numeric = [i for i in range(n_columns)
+               if i >= len(first) or _is_number(first[i])]
+    options = dict(sep=r'\s+',header=None,comment='#',
+                   names=range(n_columns))
+    try:
+        table = pd.read_csv(io.StringIO(body),usecols=numeric,dtype=float,
+                            **options)
+    except ValueError:
+        # Text in other rows, any value that is not a number is NaN
+        table = pd.read_csv(io.StringIO(body),dtype=str,**options).apply(
+            pd.to_numeric,errors='coerce')
+    data = np.full((len(table),n_columns),np.nan)
+    data[:,list(table.columns)] = table.to_numpy(dtype=float)
+    return(data)
+
+
+def read_statistics(file):
+    """
+    Read an ASPECT statistics file.
+
+    Parameters
+    ----------
+    file: Path to statistics file.
+
+    Returns
+    -------
+    statistics: Dictionary mapping each column name to a NumPy array, in
+        column order.
+    """
+    with open(file) as f:
+        text = f.read()
+    header,body = split_header(text)
+    names = parse_header(header)
+    data = parse_body(body,len(names))
+    statistics = {name:data[:,i] for i,name in enumerate(names)}
+    return(statistics)
+
+
+def find_column(names,name):
+    """
+    Find a column by its full name, or by a part of its name that matches
+    only one column, e.g. 'Time (years)' or 'Minimal value for composition
+    ve_stress_xx'.
+
+    Parameters
+    ----------
+    names: List of column names, e.g. list(statistics).
+    name: Full or partial column name.
+
+    Returns
+    -------
+    name: Full name of the column.
+    """
+    if name in names:
+        return(name)
+    matches = [column for column in names if name in column]
+    if len(matches) != 1:
+        raise KeyError("'"+name+"' matches "+str(len(matches))
+                       +" columns: "+str(matches))
+    return(matches[0])
+
+
+def get_columns(statistics,names):
+    """
+    Get columns of a statistics file by (partial) name.
+
+    Parameters
+    ----------
+    statistics: Dictionary from read_statistics.
+    names: List of full or partial column names, see find_column.
+
+    Returns
+    -------
+    columns: List of NumPy arrays, one for each name. Can be unpacked like
+        np.genfromtxt(...,unpack=True).
+    """
+    return([statistics[find_column(list(statistics),name)] for name in names])
+
+
+def _cache_entry(file,cache_dir=None):
+    """
+    Directory of the cached columns of a statistics file.
+    """
+    key = hashlib.sha1(os.path.abspath(file).encode()).hexdigest()
+    return(mesh_cache.cache_path(key,'.statistics',cache_dir))
+
+
+def _column_path(entry,version,i):
+    """
+    Path of a cached column. Every update of an entry writes new files, so
+    that files that are still memory mapped are never replaced, which
+    Windows does not allow.
+    """
+    return(os.path.join(entry,'column_%03d_v%d.npy' % (i,version)))
+
+
+def _open_entry(entry,index):
+    """
+    Open the cached columns of a statistics file as memory maps.
+    """
+    mode = 'r' if index['rows'] > 0 else None
+    statistics = {name:np.load(_column_path(entry,index['version'],i),
+                               mmap_mode=mode)
+                  for i,name in enumerate(index['names'])}
+    return(statistics)
+
+
+def _remove_stale(entry,index):
+    """
+    Remove the column files of earlier versions of an entry. Files that are
+    still memory mapped cannot be removed on Windows, they are removed by a
+    later update instead.
+    """
+    current = {os.path.basename(_column_path(entry,index['version'],i))
+               for i in range(len(index['names']))}
+    for name in os.listdir(entry):
+        if (name.startswith('column_') and name.endswith('.npy')
+                and name not in current):
+            try:
+                os.remove(os.path.join(entry,name))
+            except OSError:
+                pass
+
+
+def load_statistics(file,cache=True,cache_dir=None):
+    """
+    Read an ASPECT statistics file through the cache. See read_statistics.
+
+    The cache entry is used while the size and modification time of the file
+    are unchanged. If the file has grown, e.g. because the model is still
+    running, and its header and previously parsed rows are unchanged, only
+    the new rows are parsed and appended to the entry.
+
+    Parameters
+    ----------
+    file: Path to statistics file.
+    cache: Whether to use the cache. The default is True.
+    cache_dir: Cache directory. The default is None, which uses
+        mesh_cache.CACHE_DIR.
+
+    Returns
+    -------
+    statistics: Dictionary mapping each column name to a NumPy array (a
+        read-only memory map if cached), in column order.
+    """
+    if not cache:
+        return(read_statistics(file))
+
+    stat = os.stat(file)
+    entry = _cache_entry(file,cache_dir)
+    try:
+        with open(os.path.join(entry,'index.json')) as f:
+            index = json.load(f)
+    except (FileNotFoundError,ValueError):
+        index = None
+    if index is not None and 'version' not in index:
+        index = None
+    if (index is not None and index['size'] == stat.st_size
+            and index['mtime'] == stat.st_mtime_ns):
+        try:
+            return(_open_entry(entry,index))
+        except FileNotFoundError:
+            # Another process has just updated the entry
+            index = None
+
+    with open(file,'rb') as f:
+        data = f.read()
+    text = data.decode('latin-1')
+
+    # Parse only the new rows if the parsed part of the file is unchanged
+    tail = False
+    if index is not None and index['offset'] <= len(data):
+        header_end = index['header_end']
+        last_line = index['last_line'].encode('latin-1')
+        if (hashlib.sha1(data[:header_end]).hexdigest() == index['header']
+                and data[index['offset']-len(last_line):index['offset']]
+                == last_line):
+            tail = True
+
+    if tail:
+        end = text.rfind('\n')+1
+        body = text[index['offset']:max(end,index['offset'])]
+        names = index['names']
+        new_rows = parse_body(body,len(names))
+        old = _open_entry(entry,index)
+        columns = [np.concatenate([old[name],new_rows[:,i]])
+                   for i,name in enumerate(names)]
+        del old
+        offset = index['offset']+len(body)
+    else:
+        header,body = split_header(text)
+        header_end = sum(len(line)+1 for line in header)
+        names = parse_header(header)
+        data_rows = parse_body(body,len(names))
+        columns = [data_rows[:,i] for i in range(len(names))]
+        offset = header_end+len(body)
+
+    # Write the columns first and the index last, so that a half-written
+    # entry is never used
+    os.makedirs(entry,exist_ok=True)
+    versions = [int(match.group(1)) for match in
+                (re.match(r'column_\d+_v(\d+)\.npy$',name)
+                 for name in os.listdir(entry)) if match is not None]
+    version = max(versions,default=-1)+1
+    for i,column in enumerate(columns):
+        path = _column_path(entry,version,i)
+        tmp = mesh_cache.temporary_path(path)
+        np.save(tmp,np.ascontiguousarray(column))
+        os.replace(tmp,path)
+
+    last_start = text.rfind('\n',0,max(offset-1,0))+1
+    rows = len(columns[0]) if len(columns) > 0 else 0
+    index = dict(file=os.path.abspath(file),size=stat.st_size,
+                 mtime=stat.st_mtime_ns,version=version,names=names,rows=rows,
+                 header=hashlib.sha1(data[:header_end]).hexdigest(),
+                 header_end=header_end,offset=offset,
+                 last_line=text[last_start:offset])
+    path = os.path.join(entry,'index.json')
+    tmp = mesh_cache.temporary_path(path)
+    with open(tmp,'w') as f:
+        json.dump(index,f)
+    os.replace(tmp,path)
+    _remove_stale(entry,index)
+
+    return(_open_entry(entry,index))
+
+
+def _load_run(job):
+    """
+    Read the statistics of one run into a Pandas DataFrame.
+    """
+    run,file,columns,cache = job
+    statistics = load_statistics(os.path.join(run,file),cache)
+    names = list(statistics)
+    if columns is not None:
+        names = [find_column(names,name) for name in columns
+                 if any(name in column for column in names)]
+    table = pd.DataFrame({name:np.array(statistics[name]) for name in names})
+    time = [name for name in statistics if name.startswith('Time (')]
+    table.insert(0,'time',np.array(statistics[time[0]]) if len(time) == 1
+                 else np.nan)
+    return(table)
+
+
+def load_runs(runs,columns=None,parameters=None,file='statistics',
+              cache=True,threads=16):
+    """
+    Read the statistics files of many runs into one table.
+
+    Parameters
+    ----------
+    runs: List of run directories, or a glob pattern such as
+        base+'ve_relaxation_particles_*'.
+    columns: List of full or partial column names to read, see find_column.
+        The default is None, which reads all columns. Columns that a run
+        does not have are NaN.
+    parameters: Run parameters to add as columns, either a dictionary
+        mapping each run directory name to a dictionary of parameters or a
+        function returning that dictionary for a run directory name. The
+        default is None.
+    file: Name of the statistics file in each run directory. The default is
+        'statistics'.
+    cache: Whether to use the cache of load_statistics. The default is True.
+    threads: Number of threads reading files. The default is 16.
+
+    Returns
+    -------
+    table: Pandas DataFrame with a row per time step of each run, with the
+        columns 'run' (the run directory name), the parameters, 'time' (the
+        'Time (years)' or 'Time (seconds)' column) and the statistics
+        columns. Use e.g. table.groupby('run') to compare runs.
+    """
+    if isinstance(runs,str):
+        runs = sorted(glob.glob(runs))
+    names = [os.path.basename(os.path.normpath(run)) for run in runs]
+    jobs = [(run,file,columns,cache) for run in runs]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        tables = list(executor.map(_load_run,jobs))
+
+    for name,table in zip(names,tables):
+        if parameters is not None:
+            values = (parameters(name) if callable(parameters)
+                      else parameters.get(name,{}))
+            for i,(key,value) in enumerate(values.items()):
+                table.insert(i,key,value)
+        table.insert(0,'run',name)
+
+    if len(tables) == 0:
+        return(pd.DataFrame(columns=['run','time']))
+    table = pd.concat(tables,ignore_index=True,sort=False)
+    table['run'] = pd.Categorical(table['run'],
+                                  categories=list(dict.fromkeys(names)))
+    return(table)
+
+
+def read_new_rows(file,state):
+    """
+    Read the rows that were added to a statistics file since the last call.
+    Only the complete lines after the stored byte offset are read. If the
+    header has changed, e.g. because ASPECT added columns, the file is read
+    again and only the rows after those already read are returned. If the
+    file has become shorter than the stored offset, e.g. because a model was
+    restarted from a checkpoint, the state is reset and all rows of the file
+    are returned again. Use the 'Time step number' to drop repeated rows.
+
+    Parameters
+    ----------
+    file: Path to statistics file.
+    state: Dictionary with the offset, header and number of rows read,
+        updated in place. Use an empty dictionary for the first call.
+
+    Returns
+    -------
+    statistics: Dictionary mapping each column name to a NumPy array of the
+        new rows, or None if there are no new complete rows.
+    """
+    try:
+        size = os.path.getsize(file)
+    except FileNotFoundError:
+        return(None)
+    if size == state.get('offset',0):
+        return(None)
+    # A file smaller than the offset has been rewritten, read it from the start
+    if size < state.get('offset',0):
+        state.clear()
+
+    with open(file,'rb') as f:
+        header = state.get('header')
+        start = f.read(len(header)+1) if header is not None else b''
+        if header is not None and start[:-1] == header and start[-1:] != b'#':
+            f.seek(state['offset'])
+            body = f.read(size-state['offset']).decode('latin-1')
+            body = body[:body.rfind('\n')+1]
+            data = parse_body(body,len(state['names']))
+            state['offset'] += len(body)
+        else:
+            f.seek(0)
+            text = f.read(size).decode('latin-1')
+            lines,body = split_header(text)
+            header_end = sum(len(line)+1 for line in lines)
+            state['names'] = parse_header(lines)
+            state['header'] = text[:header_end].encode('latin-1')
+            data = parse_body(body,len(state['names']))[state.get('rows',0):]
+            state['offset'] = header_end+len(body)
+
+    state['rows'] = state.get('rows',0)+len(data)
+    if len(data) == 0:
+        return(None)
+    return({name:data[:,i] for i,name in enumerate(state['names'])})
+
+
+def poll_statistics(runs,states,file='statistics'):
+    """
+    Read the new rows of the statistics files of many runs once.
+
+    Parameters
+    ----------
+    runs: List of run directories, or a glob pattern that is expanded on
+        every poll so that new runs are picked up.
+    states: Dictionary mapping run directories to the states of
+        read_new_rows, updated in place. Use an empty dictionary for the
+        first poll.
+    file: Name of the statistics file. The default is 'statistics'.
+
+    Returns
+    -------
+    rows: List of tuples (run directory, statistics of the new rows).
+    """
+    if isinstance(runs,str):
+        runs = sorted(glob.glob(runs))
+    rows = []
+    for run in runs:
+        statistics = read_new_rows(os.path.join(run,file),
+                                   states.setdefault(run,{}))
+        if statistics is not None:
+            rows.append((run,statistics))
+    return(rows)
+
+
+def follow_statistics(runs,interval=10.,timeout=None,file='statistics'):
+    """
+    Follow the statistics files of running models, yielding the rows added
+    to each file. The first poll yields all rows already written.
+
+    Parameters
+    ----------
+    runs: List of run directories or a glob pattern, see poll_statistics.
+    interval: Time between polls in seconds. The default is 10.
+    timeout: Stop when no rows were added for this many seconds. The default
+        is None, which follows the files until the generator is closed.
+    file: Name of the statistics file. The default is 'statistics'.
+
+    Yields
+    ------
+    run: Run directory.
+    statistics: Dictionary mapping each column name to a NumPy array of the
+        new rows.
+    """
+    states = {}
+    last = time.time()
+    while True:
+        for run,statistics in poll_statistics(runs,states,file):
+            last = time.time()
+            yield(run,statistics)
+        if timeout is not None and time.time()-last > timeout:
+            return
+        time.sleep(interval)
+
+
+async def follow_statistics_async(runs,interval=10.,timeout=None,
+                                  file='statistics'):
+    """
+    Asynchronous version of follow_statistics, which reads the files in a
+    thread and waits between polls without blocking the event loop. Use as
+    'async for run,statistics in follow_statistics_async(runs):'.
+    """
+    states = {}
+    last = time.time()
+    while True:
+        rows = await asyncio.to_thread(poll_statistics,runs,states,file)
+        for run,statistics in rows:
+            last = time.time()
+            yield(run,statistics)
+        if timeout is not None and time.time()-last > timeout:
+            return
+        await asyncio.sleep(interval)
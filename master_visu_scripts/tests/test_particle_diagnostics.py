@@ -0,0 +1,40 @@
+"""
+Tests of particle_diagnostics.py on meshes written like deal.II patches.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import particle_diagnostics
+from test_particle_interpolation import _patches
+
+
+def test_cell_statistics_subdivisions():
+    mesh = _patches(3)
+    rng = np.random.default_rng(1)
+    positions = np.zeros((500,3))
+    positions[:,:2] = rng.uniform(0,3,(500,2))
+    positions[0] = [5.,5.,0.]
+    values = positions[:,:2]
+
+    statistics = particle_diagnostics.cell_statistics(mesh,positions,values,
+                                                      subdivisions=2)
+    parent = 3*np.floor(positions[1:,1]).astype(int)+np.floor(
+        positions[1:,0]).astype(int)
+    assert np.array_equal(statistics['count'],np.bincount(parent,minlength=9))
+    assert statistics['outside'] == 1
+    assert statistics['mean'].shape == (9,2)
+    for cell in range(9):
+        assert np.allclose(statistics['max'][cell],
+                           values[1:][parent == cell].max(axis=0))
+
+    # Output cells are counted separately without subdivisions
+    statistics = particle_diagnostics.cell_statistics(mesh,positions,values)
+    assert len(statistics['count']) == 36
+    assert statistics['count'].sum() == 499
+    with pytest.raises(ValueError):
+        particle_diagnostics.cell_statistics(mesh,positions,values,
+                                             subdivisions=4)
@@ -0,0 +1,73 @@
+"""
+Tests of particle_interpolation.py on meshes written like deal.II patches.
+"""
+import os
+import sys
+
+import numpy as np
+import pyvista as pv
+import vtk
+import pytest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import particle_interpolation
+
+
+def _patches(n):
+    """
+    n x n unit ASPECT cells written with 'Interpolate output = true': each
+    cell is a patch of its own 3 x 3 points and 2 x 2 consecutive quads.
+    """
+    points = []
+    cells = []
+    for j in range(n):
+        for i in range(n):
+            start = len(points)
+            for b in range(3):
+                for a in range(3):
+                    points.append([i+a/2.,j+b/2.,0.])
+            for b in range(2):
+                for a in range(2):
+                    first = start+3*b+a
+                    cells.append([4,first,first+1,first+4,first+3])
+    return(pv.UnstructuredGrid(np.array(cells).ravel(),
+                               np.full(len(cells),vtk.VTK_QUAD,
+                                       dtype=np.uint8),
+                               np.array(points)))
+
+
+def test_subdivisions():
+    mesh = _patches(4)
+    rng = np.random.default_rng(0)
+    positions = np.zeros((2000,3))
+    positions[:,:2] = rng.uniform(0,4,(2000,2))
+    values = 1.+2.*positions[:,0]+3.*positions[:,1]
+
+    result = particle_interpolation.interpolate_particles(
+        mesh,positions,values,'bilinear_least_squares',limiter=False,
+        subdivisions=2)
+    points = np.asarray(mesh.points)
+    assert np.allclose(result,1.+2.*points[:,0]+3.*points[:,1])
+
+    # The cell average of each patch is the mean of its particles
+    result = particle_interpolation.interpolate_particles(
+        mesh,positions,values,'cell_average',subdivisions=2)
+    parent = 4*np.floor(positions[:,1]).astype(int)+np.floor(
+        positions[:,0]).astype(int)
+    mean = np.bincount(parent,values)/np.bincount(parent)
+    assert np.allclose(result,mean[np.arange(mesh.n_points)//9])
+
+
+def test_subdivisions_of_higher_order_output():
+    points = np.array([[0,0,0],[1,0,0],[1,1,0],[0,1,0],[.5,0,0],[1,.5,0],
+                       [.5,1,0],[0,.5,0],[.5,.5,0]])
+    cells = np.concatenate([[9],np.arange(9)]*4)
+    offsets = np.repeat([[0.,0.,0.],[1.,0.,0.],[0.,1.,0.],[1.,1.,0.]],9,
+                        axis=0)
+    cells[np.arange(36)+np.repeat(np.arange(4),9)+1] = np.arange(36)
+    mesh = pv.UnstructuredGrid(cells,np.full(4,70,dtype=np.uint8),
+                               np.tile(points,(4,1))+offsets)
+    positions = np.array([[.5,.5,0.]])
+    with pytest.raises(ValueError):
+        particle_interpolation.interpolate_particles(
+            mesh,positions,np.ones(1),'cell_average',subdivisions=2)
@@ -0,0 +1,54 @@
+"""
+Tests of vtk_plot.particle_traces with meshes and files of particles.
+"""
+import os
+import sys
+
+import numpy as np
+import pyvista as pv
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mesh_cache
+import vtk_plot
+
+
+def _particles(step,n=20):
+    """
+    Particles of one timestep, in reverse id order in odd steps, with the
+    property 'p' = 100*step+id.
+    """
+    ids = np.arange(n) if step % 2 == 0 else np.arange(n)[::-1]
+    points = np.column_stack([ids*1000.,np.full(n,step*1000.),np.zeros(n)])
+    mesh = pv.PolyData(points)
+    mesh['id'] = ids.astype(np.int64)
+    mesh['position'] = points
+    mesh['p'] = 100.*step+ids
+    return(mesh)
+
+
+def _expected(timesteps,ids):
+    return(100.*np.asarray(timesteps)[:,None]+np.asarray(ids)[None,:])
+
+
+def test_noncontiguous_timesteps_multiblock():
+    meshes = pv.MultiBlock([_particles(step) for step in range(5)])
+    timesteps = np.array([0,2,4])
+    ids = np.array([3,7,11])
+    values = vtk_plot.particle_traces(meshes,timesteps,ids,['p','y'])
+    assert values.shape == (3,3,2)
+    assert np.array_equal(values[:,:,0],_expected(timesteps,ids))
+    assert np.array_equal(values[:,:,1],
+                          np.repeat(timesteps[:,None]*1000.,3,axis=1))
+
+
+def test_noncontiguous_timesteps_files(tmp_path,monkeypatch):
+    monkeypatch.setattr(mesh_cache,'CACHE_DIR',str(tmp_path/'cache'))
+    files = []
+    for step in range(5):
+        file = str(tmp_path/('particles-%05d.vtu' % step))
+        _particles(step).cast_to_unstructured_grid().save(file)
+        files.append(file)
+    timesteps = np.array([1,4])
+    ids = np.array([0,5,19])
+    values = vtk_plot.particle_traces(files,timesteps,ids,['p'])
+    assert np.array_equal(values[:,:,0],_expected(timesteps,ids))
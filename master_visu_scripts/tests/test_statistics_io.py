@@ -0,0 +1,133 @@
+"""
+Tests of statistics_io.py with a statistics file as written by ASPECT, with
+the text columns of the visualization and particles postprocessors.
+"""
+import os
+import sys
+import shutil
+
+import numpy as np
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import statistics_io
+
+STATISTICS = os.path.join(os.path.dirname(os.path.abspath(__file__)),'data',
+                          'statistics')
+
+
+def test_read_statistics():
+    statistics = statistics_io.read_statistics(STATISTICS)
+    assert len(statistics) == 21
+    time,stress_xx,particles = np.genfromtxt(STATISTICS,comments='#',
+                                             usecols=(1,16,19),unpack=True)
+    columns = statistics_io.get_columns(statistics,['Time (years)',
+                                                    'Minimal value',
+                                                    'advected particles'])
+    for column,expected in zip(columns,[time,stress_xx,particles]):
+        assert np.array_equal(column,expected)
+    assert np.all(np.isnan(statistics['Visualization file name']))
+    assert np.all(np.isnan(statistics['Particle file name']))
+
+
+def test_text_after_first_row():
+    with open(STATISTICS) as f:
+        text = f.read()
+    header,body = statistics_io.split_header(text)
+    body = body.replace('output-ve/solution/solution-00000','0')
+    data = statistics_io.parse_body(body,21)
+    assert data.shape == (6,21)
+    assert data[0,15] == 0 and np.all(np.isnan(data[1:,15]))
+    assert np.array_equal(data[:,1],np.arange(6)*250.)
+
+
+def test_load_statistics(tmp_path):
+    file = str(tmp_path/'statistics')
+    with open(STATISTICS) as f:
+        lines = f.readlines()
+    with open(file,'w') as f:
+        f.writelines(lines[:-2])
+    cache_dir = str(tmp_path/'cache')
+    first = statistics_io.load_statistics(file,cache_dir=cache_dir)
+    assert len(first['Time (years)']) == 4
+
+    # Only the added rows are parsed
+    with open(file,'a') as f:
+        f.writelines(lines[-2:])
+    statistics = statistics_io.load_statistics(file,cache_dir=cache_dir)
+    expected = statistics_io.read_statistics(STATISTICS)
+    assert list(statistics) == list(expected)
+    for name in expected:
+        assert np.array_equal(statistics[name],expected[name],equal_nan=True)
+    # The earlier memory maps are still valid
+    assert np.array_equal(first['Time (years)'],expected['Time (years)'][:4])
+
+
+def test_load_statistics_mapped_files(tmp_path,monkeypatch):
+    # Windows does not allow removing or replacing memory mapped files
+    def remove(path):
+        raise PermissionError(path)
+    monkeypatch.setattr(statistics_io.os,'remove',remove)
+
+    file = str(tmp_path/'statistics')
+    with open(STATISTICS) as f:
+        lines = f.readlines()
+    cache_dir = str(tmp_path/'cache')
+    loaded = []
+    for end in [len(lines)-2,len(lines)-1,len(lines)]:
+        with open(file,'w') as f:
+            f.writelines(lines[:end])
+        loaded.append(statistics_io.load_statistics(file,cache_dir=cache_dir))
+    expected = statistics_io.read_statistics(STATISTICS)
+    for statistics,rows in zip(loaded,[4,5,6]):
+        assert np.array_equal(statistics['Time (years)'],
+                              expected['Time (years)'][:rows])
+
+    # Stale files are removed once they can be
+    monkeypatch.undo()
+    del loaded
+    with open(file,'a') as f:
+        f.write(lines[-1])
+    statistics_io.load_statistics(file,cache_dir=cache_dir)
+    entry = statistics_io._cache_entry(file,cache_dir)
+    assert len(os.listdir(entry)) == len(expected)+1
+
+
+def test_load_runs(tmp_path):
+    for run in ['a_dtc250','b_dtc500']:
+        os.makedirs(str(tmp_path/run))
+        shutil.copy(STATISTICS,str(tmp_path/run/'statistics'))
+    table = statistics_io.load_runs(str(tmp_path/'*'),
+                                    columns=['Time step number',
+                                             'Maximal value'],
+                                    cache=False)
+    assert list(table.columns) == ['run','time','Time step number',
+                                   'Maximal value for composition '
+                                   've_stress_xx']
+    assert len(table) == 12
+    assert list(table.groupby('run',observed=True)['time'].max()) == [1250.,
+                                                                      1250.]
+
+
+def test_read_new_rows_after_restart(tmp_path):
+    file = str(tmp_path/'statistics')
+    with open(STATISTICS) as f:
+        lines = f.readlines()
+    header = [line for line in lines if line.startswith('#')]
+    rows = [line for line in lines if not line.startswith('#')]
+
+    state = {}
+    with open(file,'w') as f:
+        f.writelines(header+rows[:5])
+    steps = statistics_io.read_new_rows(file,state)['Time step number']
+    assert list(steps) == [0,1,2,3,4]
+    assert statistics_io.read_new_rows(file,state) is None
+
+    # Restart from a checkpoint after step 2, which rewrites the file
+    with open(file,'w') as f:
+        f.writelines(header+rows[:3])
+    steps = statistics_io.read_new_rows(file,state)['Time step number']
+    assert list(steps) == [0,1,2]
+    with open(file,'a') as f:
+        f.writelines(rows[3:])
+    steps = statistics_io.read_new_rows(file,state)['Time step number']
+    assert list(steps) == [3,4,5]
@@ -0,0 +1,41 @@
+"""
+Tests of vtk_io.py.
+"""
+import os
+import sys
+
+import numpy as np
+import pyvista as pv
+import vtk
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import vtk_io
+
+
+def _grid(nx=4,ny=3,x0=0.):
+    """
+    Quadrilateral grid with the point arrays 'T' and 'velocity'.
+    """
+    x,y = np.meshgrid(x0+np.arange(nx+1.),np.arange(ny+1.))
+    points = np.column_stack([x.ravel(),y.ravel(),np.zeros(x.size)])
+    index = np.arange(x.size).reshape(ny+1,nx+1)
+    quads = np.stack([index[:-1,:-1],index[:-1,1:],index[1:,1:],
+                      index[1:,:-1]],axis=-1).reshape(-1,4)
+    cells = np.column_stack([np.full(len(quads),4),quads]).ravel()
+    mesh = pv.UnstructuredGrid(cells,np.full(len(quads),vtk.VTK_QUAD,
+                                             dtype=np.uint8),points)
+    mesh['T'] = points[:,0]**2+points[:,1]
+    mesh['velocity'] = np.column_stack([points[:,1],-points[:,0],
+                                        np.zeros(len(points))])
+    return(mesh)
+
+
+def test_arrays_to_mesh_with_empty_piece():
+    pieces = [vtk_io.mesh_to_arrays(_grid()),
+              vtk_io.mesh_to_arrays(pv.UnstructuredGrid()),
+              vtk_io.mesh_to_arrays(_grid(x0=10.))]
+    mesh = vtk_io.arrays_to_mesh(pieces)
+    assert mesh.n_points == 2*_grid().n_points
+    assert mesh.n_cells == 2*_grid().n_cells
+    assert sorted(vtk_io.point_array_names(mesh)) == ['T','velocity']
+    assert np.array_equal(pv.point_array(mesh,'T')[:20],_grid()['T'])
@@ -0,0 +1,187 @@
+"""
+Tests of vtu_decoder.py and vtk_io.read_series against pv.read, with files
+written by VTK in each of its encodings, with and without compression.
+"""
+import os
+import sys
+
+import numpy as np
+import pyvista as pv
+import pytest
+import vtk
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import vtk_io
+import vtu_decoder
+
+ENCODINGS = ['ascii','binary','appended_raw','appended_base64']
+
+
+def _mesh(nx=5,ny=4,x0=0.,step=0):
+    """
+    Quadrilateral grid with scalar, vector and integer point arrays that
+    depend on the step.
+    """
+    x,y = np.meshgrid(x0+np.linspace(0.,1.,nx+1),np.linspace(0.,1.,ny+1))
+    points = np.column_stack([x.ravel(),y.ravel(),np.zeros(x.size)])
+    index = np.arange(x.size).reshape(ny+1,nx+1)
+    quads = np.stack([index[:-1,:-1],index[:-1,1:],index[1:,1:],
+                      index[1:,:-1]],axis=-1).reshape(-1,4)
+    cells = np.column_stack([np.full(len(quads),4),quads]).ravel()
+    mesh = pv.UnstructuredGrid(cells,np.full(len(quads),vtk.VTK_QUAD,
+                                             dtype=np.uint8),points)
+    mesh['T'] = np.sin(3.*points[:,0])+points[:,1]+step
+    mesh['velocity'] = np.column_stack([points[:,1],-points[:,0],
+                                        np.full(len(points),step)])
+    mesh['id'] = np.arange(len(points),dtype=np.int64)+step
+    mesh['density'] = (points[:,0]*step).astype(np.float32)
+    return(mesh)
+
+
+def _write(mesh,file,encoding,compressed,compressor='ZLib'):
+    """
+    Write a VTU file with the VTK writer in one of the ENCODINGS. The small
+    block size splits compressed arrays into several blocks.
+    """
+    writer = vtk.vtkXMLUnstructuredGridWriter()
+    writer.SetFileName(file)
+    writer.SetInputData(mesh)
+    if encoding == 'ascii':
+        writer.SetDataModeToAscii()
+    elif encoding == 'binary':
+        writer.SetDataModeToBinary()
+    else:
+        writer.SetDataModeToAppended()
+        writer.SetEncodeAppendedData(encoding == 'appended_base64')
+    if compressed:
+        getattr(writer,'SetCompressorTypeTo'+compressor)()
+        writer.SetBlockSize(256)
+    else:
+        writer.SetCompressorTypeToNone()
+    writer.Write()
+    return(file)
+
+
+def _write_pvtu(meshes,file,encoding,compressed):
+    """
+    Write a PVTU file with one VTU piece per mesh.
+    """
+    root = os.path.splitext(file)[0]
+    sources = []
+    for i,mesh in enumerate(meshes):
+        sources.append(os.path.basename(_write(mesh,'%s_%d.vtu' % (root,i),
+                                               encoding,compressed)))
+    arrays = ''.join('<PDataArray type="%s" Name="%s" '
+                     'NumberOfComponents="%d"/>'
+                     % (_vtk_type(meshes[0],name),name,
+                        np.atleast_2d(pv.point_array(meshes[0],
+                                                     name).T).shape[0])
+                     for name in vtk_io.point_array_names(meshes[0]))
+    with open(file,'w') as f:
+        f.write('<?xml version="1.0"?>\n'
+                '<VTKFile type="PUnstructuredGrid" version="0.1">\n'
+                '<PUnstructuredGrid GhostLevel="0">\n'
+                '<PPointData>'+arrays+'</PPointData>\n'
+                '<PPoints><PDataArray type="Float64" '
+                'NumberOfComponents="3"/></PPoints>\n'
+                +''.join('<Piece Source="%s"/>\n' % source
+                         for source in sources)
+                +'</PUnstructuredGrid>\n</VTKFile>\n')
+    return(file)
+
+
+def _vtk_type(mesh,name):
+    """
+    Name of the VTK XML type of a point array.
+    """
+    dtype = np.asarray(pv.point_array(mesh,name)).dtype
+    return([key for key,value in vtu_decoder.TYPES.items()
+            if np.dtype(value) == dtype][0])
+
+
+def _assert_equal(mesh,expected):
+    assert np.array_equal(np.asarray(mesh.points),np.asarray(expected.points))
+    assert np.array_equal(np.asarray(mesh.cells),np.asarray(expected.cells))
+    assert np.array_equal(np.asarray(mesh.celltypes),
+                          np.asarray(expected.celltypes))
+    assert (sorted(vtk_io.point_array_names(mesh))
+            == sorted(vtk_io.point_array_names(expected)))
+    for name in vtk_io.point_array_names(expected):
+        array = np.asarray(pv.point_array(mesh,name))
+        assert array.dtype == np.asarray(pv.point_array(expected,name)).dtype
+        assert np.array_equal(array,pv.point_array(expected,name))
+
+
+@pytest.mark.parametrize('compressed',[False,True])
+@pytest.mark.parametrize('encoding',ENCODINGS)
+def test_read_piece(tmp_path,encoding,compressed):
+    file = _write(_mesh(step=2),str(tmp_path/'solution.vtu'),encoding,
+                  compressed)
+    layout = vtu_decoder.parse_vtu(file)
+    mesh = vtk_io.arrays_to_mesh([vtu_decoder.read_piece(layout)])
+    _assert_equal(mesh,pv.read(file))
+
+    # Only the requested arrays are decoded
+    piece = vtu_decoder.read_piece(layout,['T','velocity'],geometry=False)
+    assert piece['points'] is None
+    assert sorted(piece['point_data']) == ['T','velocity']
+    assert np.array_equal(piece['point_data']['velocity'],
+                          pv.read(file)['velocity'])
+
+
+@pytest.mark.parametrize('compressed',[False,True])
+@pytest.mark.parametrize('encoding',ENCODINGS)
+def test_read_series(tmp_path,encoding,compressed):
+    # Steps 0 and 1 have the same geometry, step 2 is refined and step 3
+    # has the geometry of step 2 again
+    sizes = [(5,4),(5,4),(8,6),(8,6)]
+    files = []
+    for step,(nx,ny) in enumerate(sizes):
+        meshes = [_mesh(nx,ny,step=step),_mesh(nx,ny,x0=1.,step=step)]
+        files.append(_write_pvtu(meshes,str(tmp_path/('solution-%05d.pvtu'
+                                                      % step)),
+                                 encoding,compressed))
+
+    meshes = list(vtk_io.read_series(files,progress=False))
+    for mesh,file in zip(meshes,files):
+        _assert_equal(mesh,pv.read(file))
+    assert meshes[0].n_points < meshes[2].n_points
+
+    # The geometry is shared only between steps with the same geometry
+    def shared(a,b):
+        return(np.shares_memory(np.asarray(a.points),np.asarray(b.points)))
+    assert shared(meshes[0],meshes[1])
+    assert not shared(meshes[1],meshes[2])
+    assert shared(meshes[2],meshes[3])
+
+    meshes = list(vtk_io.read_series(files,arrays=['T'],progress=False))
+    for mesh,file in zip(meshes,files):
+        assert vtk_io.point_array_names(mesh) == ['T']
+        assert np.array_equal(mesh['T'],pv.read(file)['T'])
+
+
+def test_read_series_fallback(tmp_path,monkeypatch):
+    # LZ4 compressed files are not supported by vtu_decoder and are read by
+    # the VTK reader instead
+    files = [_write(_mesh(step=0),str(tmp_path/'solution-00000.vtu'),
+                    'appended_raw',True),
+             _write(_mesh(step=1),str(tmp_path/'solution-00001.vtu'),
+                    'appended_raw',True,compressor='LZ4'),
+             _write(_mesh(step=2),str(tmp_path/'solution-00002.vtu'),
+                    'appended_raw',True)]
+    with pytest.raises(ValueError):
+        vtu_decoder.parse_vtu(files[1])
+
+    fallback = []
+    read_vtu = vtk_io.read_vtu
+    def counting_read_vtu(file,arrays=None):
+        fallback.append(file)
+        return(read_vtu(file,arrays))
+    monkeypatch.setattr(vtk_io,'read_vtu',counting_read_vtu)
+
+    meshes = list(vtk_io.read_series(files,progress=False))
+    assert fallback == [files[1]]
+    for mesh,file in zip(meshes,files):
+        _assert_equal(mesh,pv.read(file))
+    assert not np.shares_memory(np.asarray(meshes[0].points),
+                                np.asarray(meshes[2].points))
@@ -0,0 +1,499 @@
+"""
+Functions for reading VTU/PVTU files written by ASPECT.
+"""
+import os
+import re
+import sys
+import hashlib
+import multiprocessing as mp
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pyvista as pv
+import vtk
+from tqdm import tqdm
+from vtk.util.numpy_support import vtk_to_numpy
+
+import vtu_decoder
+
+
+def process_pool(processes=None,initializer=None):
+    """
+    Create a process pool for reading and processing VTU files.
+
+    On Linux the 'fork' start method is used, so that scripts without an
+    ``if __name__ == '__main__':`` guard can still use the pool. Elsewhere
+    the default start method of the platform is used, since forking is not
+    safe with the system frameworks loaded by VTK and Matplotlib on macOS,
+    so scripts using the pool there need the guard.
+
+    Parameters
+    ----------
+    processes: Number of worker processes. The default is None, which uses
+        the number of CPUs.
+    initializer: Function called once in each worker process when it
+        starts. The default is None.
+
+    Returns
+    -------
+    pool: concurrent.futures.ProcessPoolExecutor
+    """
+    if sys.platform.startswith('linux'):
+        context = mp.get_context('fork')
+    else:
+        context = mp.get_context()
+    return(ProcessPoolExecutor(max_workers=processes,mp_context=context,
+                               initializer=initializer))
+
+
+def get_pieces(file):
+    """
+    Get the list of VTU pieces that make up a PVTU file.
+
+    ASPECT writes one piece per MPI rank (or per group of ranks), with the
+    piece paths given relative to the PVTU file. A VTU file is its own
+    single piece.
+
+    Parameters
+    ----------
+    file: Path to PVTU or VTU file.
+
+    Returns
+    -------
+    pieces: List of paths to the VTU pieces, in the order of the PVTU file.
+    """
+    if not file.endswith('.pvtu'):
+        return([file])
+    directory = os.path.dirname(file)
+    root = ET.parse(file).getroot()
+    pieces = [os.path.join(directory,piece.get('Source'))
+              for piece in root.iter('Piece')]
+    return(pieces)
+
+
+def piece_size(piece):
+    """
+    Get the number of points and cells of a VTU piece from the header of
+    its Piece element, without reading the rest of the file.
+
+    Parameters
+    ----------
+    piece: Path to VTU file.
+
+    Returns
+    -------
+    size: Tuple of the number of points and the number of cells.
+    """
+    header = b''
+    with open(piece,'rb') as f:
+        while True:
+            chunk = f.read(4096)
+            header += chunk
+            start = header.find(b'<Piece')
+            if start >= 0 and header.find(b'>',start) >= 0:
+                break
+            if len(chunk) == 0:
+                raise ValueError("No Piece element in "+piece)
+    tag = header[start:header.find(b'>',start)].decode('latin-1')
+    n_points = int(re.search(r'NumberOfPoints="(\d+)"',tag).group(1))
+    n_cells = int(re.search(r'NumberOfCells="(\d+)"',tag).group(1))
+    return(n_points,n_cells)
+
+
+def read_vtu(file,arrays=None):
+    """
+    Read a VTU or PVTU file, decoding only the requested point arrays.
+
+    The data blocks of all other point arrays (and of all cell arrays) are
+    skipped by the VTK reader, which saves I/O and memory in proportion to
+    the number of skipped arrays. The points and cells are always read.
+
+    Parameters
+    ----------
+    file: Path to VTU or PVTU file.
+    arrays: List of point arrays to read. The default is None, which reads
+        all arrays like pv.read.
+
+    Returns
+    -------
+    mesh: Pyvista UnstructuredGrid.
+    """
+    if file.endswith('.pvtu'):
+        reader = vtk.vtkXMLPUnstructuredGridReader()
+    else:
+        reader = vtk.vtkXMLUnstructuredGridReader()
+    reader.SetFileName(file)
+
+    if arrays is not None:
+        reader.UpdateInformation()
+        selection = reader.GetPointDataArraySelection()
+        selection.DisableAllArrays()
+        for name in arrays:
+            selection.EnableArray(name)
+        reader.GetCellDataArraySelection().DisableAllArrays()
+
+    reader.Update()
+    return(pv.wrap(reader.GetOutput()))
+
+
+def point_array_names(mesh):
+    """
+    Get the names of all point arrays of a Pyvista mesh.
+    """
+    point_data = mesh.GetPointData()
+    names = [point_data.GetArrayName(i)
+             for i in range(point_data.GetNumberOfArrays())]
+    return(names)
+
+
+def mesh_to_arrays(mesh):
+    """
+    Convert an unstructured Pyvista mesh to plain NumPy arrays so that it can
+    be passed between processes and merged with other pieces.
+
+    Parameters
+    ----------
+    mesh: Pyvista UnstructuredGrid.
+
+    Returns
+    -------
+    arrays: Dictionary with points, connectivity, offsets, celltypes and a
+        dictionary of point_data.
+    """
+    if mesh.n_cells > 0:
+        cells = mesh.GetCells()
+        connectivity = vtk_to_numpy(cells.GetConnectivityArray()).copy()
+        offsets = vtk_to_numpy(cells.GetOffsetsArray()).copy()
+        celltypes = np.asarray(mesh.celltypes).copy()
+    else:
+        connectivity = np.zeros(0,dtype=np.int64)
+        offsets = np.zeros(1,dtype=np.int64)
+        celltypes = np.zeros(0,dtype=np.uint8)
+
+    point_data = {name:np.asarray(pv.point_array(mesh,name)).copy()
+                  for name in point_array_names(mesh)}
+
+    arrays = dict(points=np.asarray(mesh.points).copy(),
+                  connectivity=connectivity,
+                  offsets=offsets,
+                  celltypes=celltypes,
+                  point_data=point_data)
+    return(arrays)
+
+
+def geometry_hash(mesh):
+    """
+    Hash the points and cells of a mesh, so that meshes with the same
+    geometry (e.g. all output steps of a model without adaptive refinement)
+    can be recognized without comparing their arrays.
+
+    Parameters
+    ----------
+    mesh: Pyvista UnstructuredGrid.
+
+    Returns
+    -------
+    key: Hexadecimal SHA-1 digest.
+    """
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(mesh.points,dtype=float).tobytes())
+    if mesh.n_cells > 0:
+        cells = mesh.GetCells()
+        for array in [cells.GetConnectivityArray(),cells.GetOffsetsArray()]:
+            digest.update(vtk_to_numpy(array).astype(np.int64).tobytes())
+        digest.update(np.asarray(mesh.celltypes,dtype=np.uint8).tobytes())
+    return(digest.hexdigest())
+
+
+def arrays_to_mesh(pieces):
+    """
+    Merge pieces created by mesh_to_arrays into a single Pyvista mesh.
+
+    Pieces are appended in the order given, which is the same order in which
+    VTK appends the pieces of a PVTU file.
+
+    Parameters
+    ----------
+    pieces: List of dictionaries created by mesh_to_arrays.
+
+    Returns
+    -------
+    mesh: Pyvista UnstructuredGrid.
+    """
+    # Empty pieces, e.g. pieces that were clipped away entirely, may lack
+    # arrays, so they are left out
+    nonempty = [piece for piece in pieces if len(piece['points']) > 0]
+    if len(nonempty) > 0:
+        pieces = nonempty
+
+    points = []
+    connectivity = []
+    counts = []
+    celltypes = []
+    n_points = 0
+    for piece in pieces:
+        points.append(piece['points'])
+        connectivity.append(piece['connectivity'] + n_points)
+        counts.append(np.diff(piece['offsets']))
+        celltypes.append(piece['celltypes'])
+        n_points += len(piece['points'])
+
+    points = np.concatenate(points)
+    connectivity = np.concatenate(connectivity).astype(np.int64)
+    counts = np.concatenate(counts).astype(np.int64)
+    celltypes = np.concatenate(celltypes).astype(np.uint8)
+
+    # Convert to the legacy VTK cell layout [n,id_0,...,id_n-1,n,...]
+    starts = np.concatenate([[0],np.cumsum(counts)[:-1]]).astype(np.int64)
+    cells = np.insert(connectivity,starts,counts)
+
+    mesh = pv.UnstructuredGrid(cells,celltypes,points)
+
+    # Only keep arrays present in every piece
+    names = [name for name in pieces[0]['point_data']
+             if all(name in piece['point_data'] for piece in pieces)]
+    for name in names:
+        mesh[name] = np.concatenate([piece['point_data'][name]
+                                     for piece in pieces])
+    return(mesh)
+
+
+def _read_piece(job):
+    """
+    Read and optionally clip a single VTU piece. Runs in a worker process.
+    """
+    piece,bounds,arrays = job
+    mesh = read_vtu(piece,arrays)
+    if (bounds is not None) and (mesh.n_points > 0):
+        mesh = mesh.clip_box(bounds=bounds,invert=False)
+    return(mesh_to_arrays(mesh))
+
+
+def read_pvtu_parallel(files,bounds=None,processes=None,arrays=None,
+                       progress=True):
+    """
+    Read PVTU (or VTU) files by reading all their VTU pieces in a process
+    pool.
+
+    The pieces of all timesteps are read at the same time and are then put
+    back together in order, giving the same meshes as calling pv.read
+    on each PVTU file.
+
+    Parameters
+    ----------
+    files: Path or list of paths to PVTU files.
+    bounds: Bounds by which to clip each piece [xmin,xmax,ymin,ymax,zmin,zmax].
+        The default is None.
+    processes: Number of worker processes. The default is None, which uses
+        the number of CPUs. Use 1 to read serially.
+    arrays: List of point arrays to read, see read_vtu. The default is None,
+        which reads all arrays.
+    progress: Whether to show a progress bar. The default is True.
+
+    Returns
+    -------
+    meshes: List of Pyvista meshes, one for each file. A single mesh if
+        files is a single path.
+    """
+    single = isinstance(files,str)
+    if single:
+        files = [files]
+
+    # One job per piece, remembering which file each piece belongs to
+    jobs = []
+    n_pieces = []
+    for file in files:
+        pieces = get_pieces(file)
+        jobs += [(piece,bounds,arrays) for piece in pieces]
+        n_pieces.append(len(pieces))
+
+    if processes == 1:
+        results = [_read_piece(job) for job in tqdm(jobs,disable=not progress)]
+    else:
+        # Schedule the largest pieces first so that workers finish together
+        sizes = [os.path.getsize(job[0]) for job in jobs]
+        order = np.argsort(sizes,kind='stable')[::-1]
+        with process_pool(processes) as pool:
+            results = list(tqdm(pool.map(_read_piece,[jobs[i] for i in order]),
+                                total=len(jobs),disable=not progress))
+        results = [results[i] for i in np.argsort(order)]
+
+    # Put the pieces of each file back together
+    meshes = []
+    start = 0
+    for n in n_pieces:
+        meshes.append(arrays_to_mesh(results[start:start+n]))
+        start += n
+
+    if single:
+        return(meshes[0])
+    return(meshes)
+
+
+def read_series(files,arrays=None,reuse_geometry=True,progress=True):
+    """
+    Read a series of PVTU (or VTU) files, reusing the points and cells of
+    the previous output step when they have not changed.
+
+    The encoded points and cells of each piece are hashed without decoding
+    them. If all pieces match the previous step, which is the case for
+    models without adaptive refinement, only the point arrays are decoded
+    and the mesh shares the points and cells of the previous mesh, so that
+    each step costs only the time and memory of its point data. Otherwise
+    (e.g. after adaptive refinement, or for files vtu_decoder cannot read)
+    the step is read in full.
+
+    Parameters
+    ----------
+    files: List of paths to PVTU or VTU files, e.g. from get_pvtu.
+    arrays: List of point arrays to read. The default is None, which reads
+        all arrays.
+    reuse_geometry: Whether to reuse the geometry of the previous step. The
+        default is True. Use False to read every step in full.
+    progress: Whether to show a progress bar. The default is True.
+
+    Yields
+    ------
+    mesh: Pyvista UnstructuredGrid for each file, in order.
+    """
+    geometry = None
+    signature = None
+    for file in tqdm(files,disable=not progress):
+        try:
+            layouts = [vtu_decoder.parse_vtu(piece)
+                       for piece in get_pieces(file)]
+        except ValueError:
+            geometry = None
+            yield read_vtu(file,arrays)
+            continue
+
+        new_signature = [vtu_decoder.geometry_signature(layout)
+                         for layout in layouts]
+        if reuse_geometry and (geometry is not None) and (
+                new_signature == signature):
+            # Share the points and cells, add the newly decoded point data
+            mesh = pv.UnstructuredGrid()
+            mesh.ShallowCopy(geometry)
+            pieces = [vtu_decoder.read_piece(layout,arrays,geometry=False)
+                      for layout in layouts]
+            names = [name for name in pieces[0]['point_data']
+                     if all(name in piece['point_data'] for piece in pieces)]
+            for name in names:
+                mesh[name] = np.concatenate([piece['point_data'][name]
+                                             for piece in pieces])
+        else:
+            mesh = arrays_to_mesh([vtu_decoder.read_piece(layout,arrays)
+                                   for layout in layouts])
+            geometry = pv.UnstructuredGrid()
+            geometry.ShallowCopy(mesh)
+            geometry.GetPointData().Initialize()
+            signature = new_signature
+        yield mesh
+
+
+# Catalogs parsed by get_catalog, keyed by path of the PVD file
+_catalogs = {}
+
+def find_pvd(directory,kind='solution'):
+    """
+    Find the PVD file of a series of ASPECT output.
+
+    Parameters
+    ----------
+    directory: ASPECT output directory, the solution or particles directory
+        containing the pvtu files, or the path to the PVD file itself.
+    kind: Whether to find standard solution or particles.
+
+    Returns
+    -------
+    pvd: Path to the PVD file, or None if it does not exist.
+    """
+    if directory.endswith('.pvd'):
+        return(directory)
+    directory = os.path.normpath(directory)
+    for candidate in [os.path.join(directory,kind+'.pvd'),
+                      os.path.join(os.path.dirname(directory),kind+'.pvd')]:
+        if os.path.isfile(candidate):
+            return(candidate)
+    return(None)
+
+
+def get_catalog(directory,kind='solution'):
+    """
+    Get the catalog of a series of ASPECT output from its PVD file.
+
+    The PVD file (solution.pvd or particles.pvd) and the pvtu files it lists
+    are parsed only once; the catalog is reused until the PVD file changes.
+
+    Parameters
+    ----------
+    directory: ASPECT output directory, the solution or particles directory
+        containing the pvtu files, or the path to the PVD file itself.
+    kind: Whether to catalog standard solution or particles.
+
+    Returns
+    -------
+    catalog: Dictionary with, for each output in the series, the model
+        'time', the output number 'index', the pvtu 'files', the 'pieces'
+        of each file and the total 'size' in bytes of the pieces. Also
+        'by_index' and 'by_time' dictionaries mapping output numbers and
+        model times to positions in the catalog.
+    """
+    pvd = find_pvd(directory,kind)
+    if pvd is None:
+        raise FileNotFoundError("No "+kind+".pvd found for "+directory)
+    pvd = os.path.abspath(pvd)
+
+    stat = os.stat(pvd)
+    signature = (stat.st_mtime_ns,stat.st_size)
+    if (pvd in _catalogs) and (_catalogs[pvd][0] == signature):
+        return(_catalogs[pvd][1])
+
+    main = os.path.dirname(pvd)
+    times = []
+    indices = []
+    files = []
+    for dataset in ET.parse(pvd).getroot().iter('DataSet'):
+        file = os.path.join(main,dataset.get('file'))
+        times.append(float(dataset.get('timestep')))
+        indices.append(int(re.search(r'-(\d+)\.p?vtu$',file).group(1)))
+        files.append(file)
+
+    pieces = [get_pieces(file) for file in files]
+    sizes = [sum(os.path.getsize(piece) for piece in file_pieces
+                 if os.path.exists(piece))
+             for file_pieces in pieces]
+
+    catalog = dict(time=np.array(times),
+                   index=np.array(indices,dtype=int),
+                   files=files,
+                   pieces=pieces,
+                   size=np.array(sizes,dtype=np.int64),
+                   by_index={index:i for i,index in enumerate(indices)},
+                   by_time={time:i for i,time in enumerate(times)})
+    _catalogs[pvd] = (signature,catalog)
+    return(catalog)
+
+
+def lookup_time(catalog,time,nearest=True):
+    """
+    Get the position in a catalog of the output at a model time.
+
+    Parameters
+    ----------
+    catalog: Catalog from get_catalog.
+    time: Model time, in the units of the PVD file (years if ASPECT uses
+        years in output).
+    nearest: Whether to return the output closest in time if no output
+        exists at exactly this time. The default is True.
+
+    Returns
+    -------
+    position: Position in the catalog lists and arrays.
+    """
+    if time in catalog['by_time']:
+        return(catalog['by_time'][time])
+    if not nearest:
+        raise KeyError("No output at time "+str(time))
+    return(int(np.argmin(np.abs(catalog['time']-time))))
@@ -2,18 +2,27 @@
 Functions for plotting data from VTU/PVTU files.
 """
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 import pyvista as pv
+import vtk
 from tqdm import tqdm
+from vtk.util.numpy_support import vtk_to_numpy
 from cmcrameri import cm
 
+import mesh_cache
+import particle_store
+import spatial_index
+import vtk_io
+
 def plot(file,field,bounds,ax=None,contours=False,
          cfields=['crust_upper','crust_lower','mantle_lithosphere'],
-         null_field='asthenosphere',plot_scalar_bar=True,**kwargs):
+         null_field='asthenosphere',plot_scalar_bar=True,cache=True,**kwargs):
     """
     Plot 2D ASPECT results using Pyvista.
 
@@ -29,6 +38,11 @@ def plot(file,field,bounds,ax=None,contours=False,
         The default is ['crust_upper','crust_lower','mantle_lithosphere'].
     null_field : Null field if field is 'comp_field.'
         The default is 'asthenosphere'.
+    cache : Whether to reuse a previously rendered image from the cache,
+        see render. The default is True.
+    
+    The clipped mesh and the rendered image are kept in the cache, see 
+    mesh_cache.py.
 
     Returns
     -------
@@ -36,19 +50,23 @@ def plot(file,field,bounds,ax=None,contours=False,
 
     """
     
-    mesh = pv.read(file)
+    img = render(file,field,bounds,contours=contours,cfields=cfields,
+                 null_field=null_field,plot_scalar_bar=plot_scalar_bar,
+                 cache=cache,**kwargs)
     
-    km2m = 1000
-    bounds_m = [bound*km2m for bound in bounds] # Convert bounds to m
-    bounds_3D = bounds_m + [0,0]
-    mesh = mesh.clip_box(bounds=bounds_3D,invert=False)
-    
-    if field=='comp_field':
-        mesh = comp_field_vtk(mesh,fields=cfields,null_field=null_field)
+    # Plot using imshow
+    if ax is None:
+        ax = plt.gca()
     
-    if contours==True:
-        cntrs = add_contours(mesh)
+    ax.imshow(img,aspect='equal',extent=bounds)
     
+    return(ax)
+
+
+def set_theme():
+    """
+    Set the Pyvista theme used for all plots.
+    """
     # Format text 
     pv.set_plot_theme("document")
     pv.global_theme.font.family = 'arial'
@@ -62,18 +80,22 @@ def plot(file,field,bounds,ax=None,contours=False,
     pv.global_theme.colorbar_horizontal.position_x = 0.21
     pv.global_theme.colorbar_horizontal.position_y = 0.01
 
-    color_bar_args = dict(
-        title_font_size=40,
-        label_font_size=36,
-        shadow=False,
-        n_labels=3,
-        italic=False,
-        fmt="%1.1e",
-        font_family="arial",
-    )
 
-    plotter = pv.Plotter(off_screen=True)
+def field_style(field):
+    """
+    Get the color bar limits, color map and color bar title of a field.
+
+    Parameters
+    ----------
+    field : Field to use for color.
 
+    Returns
+    -------
+    clim : Min/max limits of the color bar.
+    color_map : Color map.
+    title : Color bar title.
+
+    """
     # Select color map and color bar title for each field.
     # Also set the min/max limits for the color bar, change as needed.
     #TODO write powers as superscript as required by Solid Earth
@@ -81,46 +103,138 @@ def plot(file,field,bounds,ax=None,contours=False,
         #TODO convert to MPa and write symbol sigma
         clim = [0, 250e6]
         color_map = cm.batlow_r
-        color_bar_args["title"] = "sigma_xx [Pa]"
+        title = "sigma_xx [Pa]"
     elif field=='ve_stress_xy':
         clim = [0, 250e6]
         color_map = cm.batlow_r
-        color_bar_args["title"] = "sigma_xy [Pa]"
+        title = "sigma_xy [Pa]"
     elif field=='ve_stress_yy':
         clim = [0, 250e6]
         color_map = cm.batlow_r
-        color_bar_args["title"] = "sigma_yy [Pa]"
+        title = "sigma_yy [Pa]"
     elif field=='density':
         clim = [2500, 3500]
         color_map = cm.devon_r
-        color_bar_args["title"] = "Density [kg/m3]"
+        title = "Density [kg/m3]"
     elif field=='T':
         clim = [273, 1873]
         color_map = cm.lajolla
-        color_bar_args["title"] = "Temperature [K]"
+        title = "Temperature [K]"
     elif field=='viscosity':
         clim = [1e19, 1e25]
         color_map = cm.bilbao
-        color_bar_args["title"] = "Viscosity [Pa s]"
+        title = "Viscosity [Pa s]"
     elif field=='p':
         clim = [0, 2e9]
         color_map = cm.imola_r
-        color_bar_args["title"] = "Pressure [Pa]"
+        title = "Pressure [Pa]"
     elif field=='strain_rate':
         clim = [1e-20, 1e-14]
         color_map = cm.grayC
-        color_bar_args["title"] = "Strain rate [1/s]"
+        title = "Strain rate [1/s]"
     elif field=='velocity':
         clim = [0, 0.1]
         color_map = cm.davos_r
-        color_bar_args["title"] = "Velocity magnitude [m/yr]"
+        title = "Velocity magnitude [m/yr]"
     #TODO how to specify a component of the velocity?
     #elif field=='velocity_x':
     #    clim = [0, 0.1]
     #    color_map = cm.cork
-    #    color_bar_args["title"] = "X-velocity [m/yr]"
+    #    title = "X-velocity [m/yr]"
     else:
         print("This field variable is not recognized")
+        clim = None
+        color_map = None
+        title = None
+
+    return(clim,color_map,title)
+
+
+def render(file,field,bounds,contours=False,
+           cfields=['crust_upper','crust_lower','mantle_lithosphere'],
+           null_field='asthenosphere',plot_scalar_bar=True,plotter=None,
+           processes=1,cache=True,**kwargs):
+    """
+    Render 2D ASPECT results to an image using Pyvista. See plot for the
+    parameters.
+    
+    Parameters
+    ----------
+    plotter : Off-screen Pyvista plotter to reuse. It is cleared with 
+        clear_plotter and the theme is assumed to be set already. The default 
+        is None, which sets the theme and creates a new plotter.
+    processes : Number of worker processes used to read the file. The
+        default is 1, which reads it in this process. Use None for the 
+        number of CPUs.
+    cache : Whether to reuse a previously rendered image from the cache.
+        Images are keyed by the file contents, field, bounds, color bar 
+        limits, color map, contours and window size. The default is True.
+
+    Returns
+    -------
+    img: NumPy array with the RGBA image.
+
+    """
+    
+    km2m = 1000
+    bounds_m = [bound*km2m for bound in bounds] # Convert bounds to m
+    bounds_3D = bounds_m + [0,0]
+    
+    clim,color_map,title = field_style(field)
+    
+    # Calculate Camera Position from Bounds
+    bounds_array = np.array(bounds_m)
+    xmag = float(abs(bounds_array[1] - bounds_array[0]))
+    ymag = float(abs(bounds_array[3] - bounds_array[2]))
+    aspect_ratio = ymag/xmag
+    window_size = (1024,int(1024*aspect_ratio))
+    
+    # Reuse the image if it was rendered before
+    if cache:
+        key = mesh_cache.cache_key(
+            file,kind='image',field=field,bounds=bounds,contours=contours,
+            cfields=cfields,null_field=null_field,
+            plot_scalar_bar=plot_scalar_bar,clim=clim,
+            color_map=getattr(color_map,'name',None),title=title,
+            window_size=window_size,kwargs=kwargs)
+        path = mesh_cache.lookup(key,'.npy')
+        if path is not None:
+            return(np.load(path))
+    
+    # Only read the arrays needed for this plot
+    if field=='comp_field':
+        arrays = list(cfields)
+    else:
+        arrays = [field]
+    if contours==True:
+        arrays.append('T')
+    mesh = mesh_cache.load_mesh(file,bounds=bounds_3D,arrays=arrays,
+                                processes=processes)
+    
+    if field=='comp_field':
+        mesh = comp_field_vtk(mesh,fields=cfields,null_field=null_field)
+    
+    if contours==True:
+        cntrs = add_contours(mesh)
+    
+    color_bar_args = dict(
+        title_font_size=40,
+        label_font_size=36,
+        shadow=False,
+        n_labels=3,
+        italic=False,
+        fmt="%1.1e",
+        font_family="arial",
+    )
+    if title is not None:
+        color_bar_args["title"] = title
+
+    reuse_plotter = plotter is not None
+    if reuse_plotter:
+        clear_plotter(plotter)
+    else:
+        set_theme()
+        plotter = pv.Plotter(off_screen=True)
 
     plotter.add_mesh(mesh,scalars=field,clim=clim,scalar_bar_args=color_bar_args,cmap=color_map,**kwargs)
 
@@ -133,15 +247,12 @@ def plot(file,field,bounds,ax=None,contours=False,
     if contours == True:
         plotter.add_mesh(cntrs,color='black',line_width=5)
     
-    plotter.view_xy()
-    
-    # Calculate Camera Position from Bounds
-    bounds_array = np.array(bounds_m)
-    xmag = float(abs(bounds_array[1] - bounds_array[0]))
-    ymag = float(abs(bounds_array[3] - bounds_array[2]))
-    aspect_ratio = ymag/xmag
+    # On a reused plotter view_xy renders with a reset camera, which ends up
+    # in the screenshot. The camera is set explicitly below anyway.
+    if not reuse_plotter:
+        plotter.view_xy()
     
-    plotter.window_size = (1024,int(1024*aspect_ratio))
+    plotter.window_size = window_size
     
     xmid = xmag/2 + bounds_array[0] # X midpoint
     ymid = ymag/2 + bounds_array[2] # Y midpoint
@@ -160,18 +271,82 @@ def plot(file,field,bounds,ax=None,contours=False,
     img = plotter.screenshot(transparent_background=True,
                              return_img=True)
     
-    # Plot using imshow
-    if ax is None:
-        ax = plt.gca()
+    if cache:
+        path = mesh_cache.cache_path(key,'.npy')
+        tmp = mesh_cache.temporary_path(path)
+        np.save(tmp,img)
+        os.replace(tmp,path)
+        mesh_cache.evict()
     
-    ax.imshow(img,aspect='equal',extent=bounds)
+    return(img)
+
+
+def clear_plotter(plotter):
+    """
+    Remove all meshes and the scalar bar from a plotter so it can be reused.
+    Unlike plotter.clear, this keeps the lights.
+    """
+    if len(plotter.scalar_bars) > 0:
+        plotter.remove_scalar_bar()
+    for actor in list(plotter.renderer.actors.values()):
+        plotter.remove_actor(actor)
+
+
+# Plotter kept alive in each worker process of render_batch
+_worker_plotter = None
+
+def _init_render_worker():
+    """
+    Set the theme and create the plotter of a render_batch worker.
+    """
+    global _worker_plotter
+    set_theme()
+    _worker_plotter = pv.Plotter(off_screen=True)
+
+
+def _render_job(job):
+    """
+    Render a single render_batch job on the plotter of this worker.
+    """
+    job = dict(job)
+    frame = job.pop('frame',None)
+    job.setdefault('processes',1) # Workers already run in parallel
+    img = render(plotter=_worker_plotter,**job)
+    if frame is not None:
+        plt.imsave(frame,img)
+        return(frame)
+    return(img)
+
+
+def render_batch(jobs,processes=None):
+    """
+    Render many plots on a pool of worker processes. Each worker sets the 
+    theme and creates its off-screen plotter once and reuses it for all 
+    its jobs.
     
-    return(ax)
+    Parameters
+    ----------
+    jobs: List of dictionaries with the arguments of render, e.g.
+        dict(file=file,field='ve_stress_xx',bounds=[0,100,0,100]). 
+        If a job has a 'frame' entry, the image is saved to that path
+        instead of being returned.
+    processes: Number of worker processes. The default is None, which uses
+        the number of CPUs.
+    
+    Returns
+    -------
+    images: List with for each job the RGBA image as NumPy array, or the
+        path of the saved frame.
+    """
+    with vtk_io.process_pool(processes,initializer=_init_render_worker) as pool:
+        images = list(tqdm(pool.map(_render_job,jobs),total=len(jobs)))
+    return(images)
 
 
 def add_contours(mesh,field='T',values=np.arange(500,1700,200)):
     """
-    Add contours to mesh in Pyvista.
+    Add contours to mesh in Pyvista. The contour filter reads the field 
+    directly, so the mesh is neither copied nor modified.
 
     Parameters
     ----------
@@ -185,18 +360,172 @@ def add_contours(mesh,field='T',values=np.arange(500,1700,200)):
     cntrs: Pyvista mesh containing the contours.
 
     """
-    contour_mesh = mesh.copy()
-    cntrs = contour_mesh.contour(isosurfaces=values,scalars=field)
+    cntrs = contour_sets(mesh,field,[values])[0]
     return(cntrs)
+
+
+def contour_sets(mesh,field,value_sets):
+    """
+    Compute several sets of contours of a field in one pass of the contour
+    filter, without copying the mesh.
     
+    Parameters
+    ----------
+    mesh : Pyvista mesh object.
+    field : Scalar in Pyvista mesh object to use for contours, e.g. 'T'.
+    value_sets : List of arrays of contour values, e.g. 
+        [np.arange(500,1700,200),[1300]].
+    
+    Returns
+    -------
+    cntrs: List of Pyvista PolyData, the contours of each set of values.
+    """
+    
+    value_sets = [np.atleast_1d(np.asarray(values,dtype=float)) 
+                  for values in value_sets]
+    all_values = np.unique(np.concatenate(value_sets))
+    
+    contour = vtk.vtkContourFilter()
+    contour.SetInputData(mesh)
+    contour.SetInputArrayToProcess(
+        0,0,0,vtk.vtkDataObject.FIELD_ASSOCIATION_POINTS,field)
+    contour.SetNumberOfContours(len(all_values))
+    for i,value in enumerate(all_values):
+        contour.SetValue(i,value)
+    contour.ComputeScalarsOn()
+    contour.Update()
+    output = pv.wrap(contour.GetOutput())
+    
+    if len(value_sets) == 1:
+        return([output])
+    
+    # Contour value of each cell, from the value of its first point. The
+    # contours are lines in 2D and polygons in 3D, and PolyData numbers its
+    # cells as vertices, lines, polygons and strips.
+    first = []
+    for cells in [output.GetVerts(),output.GetLines(),output.GetPolys(),
+                  output.GetStrips()]:
+        offsets = vtk_to_numpy(cells.GetOffsetsArray())
+        first.append(vtk_to_numpy(cells.GetConnectivityArray())[offsets[:-1]])
+    first = np.concatenate(first).astype(np.int64)
+    scalars = np.asarray(pv.point_array(output,field))[first]
+    nearest = np.abs(scalars[:,None]-all_values[None,:]).argmin(axis=1)
+    
+    cntrs = []
+    for values in value_sets:
+        cells = np.flatnonzero(np.isin(all_values[nearest],values))
+        surface = vtk.vtkDataSetSurfaceFilter()
+        surface.SetInputData(output.extract_cells(cells))
+        surface.Update()
+        cntrs.append(pv.wrap(surface.GetOutput()))
+    return(cntrs)
+
+
+def _contour_job(job):
+    """
+    Read a file and cache its contours. Runs in a worker process.
+    """
+    file,field,value_sets,bounds,keys = job
+    mesh = vtk_io.read_pvtu_parallel(file,bounds=bounds,processes=1,
+                                     arrays=[field],progress=False)
+    for cntrs,key in zip(contour_sets(mesh,field,value_sets),keys):
+        path = mesh_cache.cache_path(key,'.vtp')
+        tmp = mesh_cache.temporary_path(path)
+        cntrs.save(tmp)
+        os.replace(tmp,path)
+
+
+def contour_series(files,field='T',value_sets=[np.arange(500,1700,200)],
+                   bounds=None,processes=None):
+    """
+    Compute contours for a series of files. The contours of each file, field
+    and set of values are kept in the cache (see mesh_cache.py), and files 
+    with missing contours are contoured in a process pool, reading only the 
+    field.
+    
+    Parameters
+    ----------
+    files: List of paths to VTU or PVTU files, e.g. from get_pvtu.
+    field : Scalar to use for contours. The default is T.
+    value_sets : List of arrays of contour values. The default is 
+        [np.arange(500,1700,200)].
+    bounds: Bounds by which to clip the meshes [xmin,xmax,ymin,ymax,zmin,zmax].
+        The default is None.
+    processes: Number of worker processes. The default is None, which uses 
+        the number of CPUs. Use 1 to contour serially.
+    
+    Returns
+    -------
+    cntrs: List with, for each file, a list of Pyvista PolyData of the 
+        contours of each set of values.
+    """
+    
+    value_sets = [np.atleast_1d(np.asarray(values,dtype=float)) 
+                  for values in value_sets]
+    keys = [[mesh_cache.cache_key(file,kind='contours',field=field,
+                                  values=values,bounds=bounds) 
+             for values in value_sets] for file in files]
+    
+    jobs = []
+    for file,file_keys in zip(files,keys):
+        missing = [mesh_cache.lookup(key,'.vtp') is None for key in file_keys]
+        if any(missing):
+            jobs.append((file,field,
+                         [values for values,m in zip(value_sets,missing) if m],
+                         bounds,[key for key,m in zip(file_keys,missing) if m]))
+    
+    if processes == 1:
+        for job in tqdm(jobs):
+            _contour_job(job)
+    elif len(jobs) > 0:
+        with vtk_io.process_pool(processes) as pool:
+            list(tqdm(pool.map(_contour_job,jobs),total=len(jobs)))
+    if len(jobs) > 0:
+        mesh_cache.evict()
+    
+    cntrs = [[pv.read(mesh_cache.cache_path(key,'.vtp')) for key in file_keys]
+             for file_keys in keys]
+    return(cntrs)
+    
+
+def comp_labels(mesh,fields=['crust_upper','crust_lower','mantle_lithosphere'],
+                threshold=0.5):
+    """
+    Classify the points of a mesh by composition in a single pass over the 
+    stacked compositional fields.
+    
+    Parameters
+    ----------
+    mesh : Pyvista mesh
+    fields : Names of compositional fields that are scalars in the mesh.
+        The default is ['crust_upper','crust_lower','mantle_lithosphere'].
+    threshold : Value above which a point belongs to a field. The default 
+        is 0.5.
+    
+    Returns
+    -------
+    labels: uint8 NumPy array with the number (starting from 1) of the last 
+        field above the threshold at each point, 0 for the null field.
+    """
+    
+    # Boolean stack of the fields, reversed so that argmax finds the last 
+    # field above the threshold like the former one-pass-per-field loop
+    above = np.stack([np.asarray(pv.point_array(mesh,field)) > threshold
+                      for field in fields[::-1]])
+    last = np.argmax(above,axis=0)
+    inside = np.take_along_axis(above,last[None],axis=0)[0]
+    labels = np.where(inside,len(fields)-last,0).astype(np.uint8)
+    return(labels)
+
 
 def comp_field_vtk(mesh,fields=['crust_upper','crust_lower','mantle_lithosphere'],
-               null_field='asthenosphere'):
+               null_field='asthenosphere',threshold=0.5):
     """
     Calculate compositional field from Pyvista VTK mesh.
     
-    Uses input fields to assign value based on when fields are >0.9. Any point
-    lacking a field >0.9 is assigned to the null field.
+    Uses input fields to assign value based on when fields are >threshold, 
+    see comp_labels. Any point lacking a field >threshold is assigned to the 
+    null field.
 
     Parameters
     ----------
@@ -205,23 +534,70 @@ def comp_field_vtk(mesh,fields=['crust_upper','crust_lower','mantle_lithosphere'
         The default is ['crust_upper','crust_lower','mantle_lithosphere'].
     null_field : Name of field for points not included in compositional fields.
         The default is 'asthenosphere'.
+    threshold : Value above which a point belongs to a field. The default 
+        is 0.5.
 
     Returns
     -------
-    mesh: Pyvista mesh with 'comp_field' added as a scalar.
+    mesh: Pyvista mesh with 'comp_field' added as a uint8 scalar.
     
     """
-
-    # Create empty np array
-    output = np.zeros(shape=mesh.point_arrays[fields[0]].shape)
-    for x in range(len(fields)):
-        array = mesh.point_arrays[fields[x]]
-        output = np.where(array>0.5,x+1,output)
     
-    mesh.point_arrays['comp_field'] = output
+    mesh['comp_field'] = comp_labels(mesh,fields,threshold)
     return(mesh)
 
 
+def comp_label_series(files,fields=['crust_upper','crust_lower','mantle_lithosphere'],
+                      threshold=0.5,cache=True,processes=None):
+    """
+    Classify the points of a series of meshes by composition, see 
+    comp_labels. The label map of each file is kept in the cache (see 
+    mesh_cache.py), and only the compositional fields are read for files 
+    that are not cached yet. These files are read one at a time with 
+    iter_meshes, so that only the current and the next mesh are in memory.
+    
+    Parameters
+    ----------
+    files: List of paths to VTU or PVTU files, e.g. from get_pvtu.
+    fields : Names of compositional fields.
+        The default is ['crust_upper','crust_lower','mantle_lithosphere'].
+    threshold : Value above which a point belongs to a field. The default 
+        is 0.5.
+    cache: Whether to use the cache. The default is True.
+    processes: Number of worker processes used to read the pieces of each 
+        file. The default is None, which uses the number of CPUs.
+    
+    Returns
+    -------
+    labels: List of uint8 NumPy arrays, one for each file.
+    """
+    
+    labels = [None]*len(files)
+    keys = [mesh_cache.cache_key(file,kind='comp_labels',fields=fields,
+                                 threshold=threshold) for file in files]
+    missing = []
+    for i,key in enumerate(keys):
+        path = mesh_cache.lookup(key,'.npy') if cache else None
+        if path is None:
+            missing.append(i)
+        else:
+            labels[i] = np.load(path)
+    
+    if len(missing) > 0:
+        meshes = iter_meshes([files[i] for i in missing],arrays=fields,
+                             processes=processes)
+        for i,mesh in zip(missing,meshes):
+            labels[i] = comp_labels(mesh,fields,threshold)
+            if cache:
+                path = mesh_cache.cache_path(keys[i],'.npy')
+                tmp = mesh_cache.temporary_path(path)
+                np.save(tmp,labels[i])
+                os.replace(tmp,path)
+        if cache:
+            mesh_cache.evict()
+    return(labels)
+
+
 def particle_trace(meshes,timesteps,point,y_field,x_field='time',
                    bounds=None,plot_path=False):
     """
@@ -233,7 +609,11 @@ def particle_trace(meshes,timesteps,point,y_field,x_field='time',
     
     Parameters
     ----------
-    meshes: MultiBlock object from laod_particle_meshes function
+    meshes: MultiBlock object from laod_particle_meshes function, or list of
+        particle pvtu files from get_pvtu. Files are streamed one at a time
+        through the mesh cache, see iter_meshes. Can also be a particle 
+        store opened with particle_store.open_store, from which only the
+        values of this particle are read.
     timesteps: NumPy array of timesteps to pull
     point: ID of particle to trace
     y_field: Particle property for y-axis
@@ -255,48 +635,70 @@ def particle_trace(meshes,timesteps,point,y_field,x_field='time',
     first = timesteps[0]
     last = timesteps[-1]
     
-    # Loop over files
+    # Read only the required slices from a particle store
+    if isinstance(meshes,dict):
+        if (x_field == 'position') & (y_field == 'position'):
+            x_field = 'x'
+            y_field = 'y'
+        if x_field!='time':
+            values = particle_store.store_traces(meshes,timesteps,point,
+                                                 [x_field,y_field],bounds)
+            x_point = list(values[:,0,0])
+            y_point = list(values[:,0,1])
+        else:
+            values = particle_store.store_traces(meshes,timesteps,point,
+                                                 [y_field],bounds)
+            y_point = list(values[:,0,0])
     
-    for mesh in meshes[first:last+1]:
+    else:
+        # Stream the files through the mesh cache, which already clips them
+        if isinstance(meshes,list):
+            meshes = iter_meshes(meshes[first:last+1],bounds=bounds,cache=True)
+            bounds = None
+        else:
+            meshes = meshes[first:last+1]
         
-        # Clip mesh if needed
-        if bounds is not None:
-            mesh = mesh.clip_box(bounds=bounds,invert=False)
+        # Loop over files
+    
+        for mesh in meshes:
         
-        ids = pv.point_array(mesh,'id') # Get particle ids
-        y_vals = pv.point_array(mesh,y_field) # Get y field values
+            # Select particles inside the bounds if needed
+            inside = select_box(mesh,bounds)
         
-        if y_field=='position': # If y array is 3D position
-            x_vals = y_vals[:,0] # Get x coordinates
-            y_vals = y_vals[:,1] # Get y coordinates
-
-            # Rename fields if plotting 2D position
-            if (x_field == 'position') & (y_field == 'position'):
-                x_field = 'x'
-                y_field = 'y' 
-                df = pd.DataFrame(
-                {x_field:x_vals,y_field:y_vals},index=ids.astype(int))
+            ids = pv.point_array(mesh,'id')[inside] # Get particle ids
+            y_vals = pv.point_array(mesh,y_field)[inside] # Get y field values
         
-        # Get x field values if not plotting timesteps or 2D position
-        elif x_field!='time':
-            x_vals = pv.point_array(mesh,x_field)
-            df = pd.DataFrame(
-                {x_field:x_vals,y_field:y_vals},index=ids.astype(int))
-        else:
-            df = pd.DataFrame({y_field:y_vals},index=ids.astype(int))
+            if y_field=='position': # If y array is 3D position
+                x_vals = y_vals[:,0] # Get x coordinates
+                y_vals = y_vals[:,1] # Get y coordinates
+
+                # Rename fields if plotting 2D position
+                if (x_field == 'position') & (y_field == 'position'):
+                    x_field = 'x'
+                    y_field = 'y' 
+                    df = pd.DataFrame(
+                    {x_field:x_vals,y_field:y_vals},index=ids.astype(int))
         
-        # Extract values for specific points and add to lists
-        point_vals = df.loc[point,:]
-        y = point_vals[y_field]
-        if x_field!='time':
-            x = point_vals[x_field]
-            x_point.append(x)
-        y_point.append(y)
+            # Get x field values if not plotting timesteps or 2D position
+            elif x_field!='time':
+                x_vals = pv.point_array(mesh,x_field)[inside]
+                df = pd.DataFrame(
+                    {x_field:x_vals,y_field:y_vals},index=ids.astype(int))
+            else:
+                df = pd.DataFrame({y_field:y_vals},index=ids.astype(int))
+        
+            # Extract values for specific points and add to lists
+            point_vals = df.loc[point,:]
+            y = point_vals[y_field]
+            if x_field!='time':
+                x = point_vals[x_field]
+                x_point.append(x)
+            y_point.append(y)
         
-        # Reset position fields if needed
-        if (x_field == 'x') & (y_field == 'y'):
-            x_field = 'position'
-            y_field = 'position' 
+            # Reset position fields if needed
+            if (x_field == 'x') & (y_field == 'y'):
+                x_field = 'position'
+                y_field = 'position' 
 
     
     # Convert lists to dataframe
@@ -330,40 +732,148 @@ def particle_trace(meshes,timesteps,point,y_field,x_field='time',
         
     return(point_df)
 
+def select_box(mesh,bounds):
+    """
+    Select the points of a mesh inside bounds with a cached spatial index,
+    see spatial_index.py. Unlike mesh.clip_box, no new mesh is created.
+    
+    Parameters
+    ----------
+    mesh: Pyvista mesh, e.g. one block of load_particle_meshes.
+    bounds: List of bounds [xmin,xmax,ymin,ymax,zmin,zmax], or None.
+    
+    Returns
+    -------
+    inside: NumPy array of the indices of the points inside bounds, or a 
+        slice selecting all points if bounds is None.
+    """
+    if bounds is None:
+        return(slice(None))
+    return(spatial_index.query_box(spatial_index.get_index(mesh),bounds))
+
+
+def match_ids(ids,query):
+    """
+    Find the rows of particles with the given ids using a sorted id array.
+    
+    Parameters
+    ----------
+    ids: NumPy array of particle ids in one mesh.
+    query: NumPy array of particle ids to look up.
+    
+    Returns
+    -------
+    rows: NumPy array of the row of each queried id in ids.
+    found: Boolean NumPy array, False where a queried id is not in ids. The
+        rows of these ids are meaningless.
+    """
+    ids = np.asarray(ids).astype(np.int64)
+    query = np.asarray(query).astype(np.int64)
+    
+    if len(ids)==0:
+        return(np.zeros(len(query),dtype=np.int64),
+               np.zeros(len(query),dtype=bool))
+    
+    order = np.argsort(ids,kind='stable')
+    sorted_ids = ids[order]
+    positions = np.searchsorted(sorted_ids,query)
+    positions = np.minimum(positions,len(sorted_ids)-1)
+    found = sorted_ids[positions]==query
+    rows = order[positions]
+    return(rows,found)
+
+
+def particle_traces(meshes,timesteps,points,fields,bounds=None):
+    """
+    Get the paths of many particles over multiple timesteps in a single pass
+    over the meshes generated by load_particle_meshes.
+    
+    Parameters
+    ----------
+    meshes: MultiBlock object from load_particle_meshes, or list of particle
+        pvtu files from get_pvtu, which are streamed one at a time through 
+        the mesh cache, see iter_meshes.
+    timesteps: NumPy array of timesteps to pull
+    points: NumPy array of IDs of particles to trace
+    fields: List of particle properties to extract. Use 'x', 'y' and 'z' for
+        the components of the particle position. Other properties must be
+        scalars.
+    bounds: List of bounds to clip model [xmin,xmax,ymin,ymax,zmin,zmax].
+        Note that 0 indicates bottom
+    
+    Returns
+    -------
+    values: NumPy array of shape (timesteps,points,fields). Values of
+        particles that do not exist in a timestep (or lie outside the bounds)
+        are NaN.
+    """
+    
+    points = np.atleast_1d(points)
+    values = np.full((len(timesteps),len(points),len(fields)),np.nan)
+    
+    # Only visit the requested timesteps. Stream the files through the mesh 
+    # cache, which already clips them
+    if isinstance(meshes,list):
+        meshes = iter_meshes([meshes[t] for t in timesteps],bounds=bounds,
+                             cache=True)
+        bounds = None
+    else:
+        meshes = [meshes[int(t)] for t in timesteps]
+    
+    components = {'x':0,'y':1,'z':2}
+    
+    for i,mesh in enumerate(meshes):
+        
+        # Select particles inside the bounds if needed
+        inside = select_box(mesh,bounds)
+        
+        rows,found = match_ids(pv.point_array(mesh,'id')[inside],points)
+        rows = np.arange(mesh.n_points)[inside][rows[found]]
+        
+        for j,field in enumerate(fields):
+            if field in components:
+                column = pv.point_array(mesh,'position')[:,components[field]]
+            else:
+                column = pv.point_array(mesh,field)
+            values[i,found,j] = column[rows]
+    
+    return(values)
+
 def get_pvtu(directory,timesteps,kind='solution'):
     """
     Get list of .pvtu files from directory and timesteps.
     
-    Assumes files are named according to ASPECT output conventions and in a
-    single directory. Can be used for standard solution or particle naming
-    schemes.
+    If ASPECT wrote a solution.pvd or particles.pvd file for the directory,
+    the files are looked up in its catalog (see vtk_io.get_catalog).
+    Otherwise assumes files are named according to ASPECT output 
+    conventions and in a single directory. Can be used for standard 
+    solution or particle naming schemes.
     
     Parameters
     ----------
     directory: Path to directory contaning ASPECT pvtu files.
-    timesteps: Integer or NumPy array of timesteps to pull
+    timesteps: Integer or NumPy array of timesteps (output numbers) to pull
     kind: Whether to pull standard solution or particles.
     
     Returns
     -------
     files: List of file paths
     """    
-    # Set up directory building blocks
-    main = directory
-    if kind=='solution':
-        prefix = 'solution-00'
-    if kind == 'particles':
-        prefix = 'particles-00'
-    suffix = '.pvtu'
-    
-    # Get file paths for all timesteps
-    if type(timesteps)==int:
-        timesteps_str = str(timesteps).zfill(3)
-        files = os.path.join(main,prefix+timesteps_str+suffix)
+    single = type(timesteps)==int
+    timesteps = np.atleast_1d(timesteps).tolist()
+    
+    if vtk_io.find_pvd(directory,kind) is not None:
+        catalog = vtk_io.get_catalog(directory,kind)
+        files = [catalog['files'][catalog['by_index'][x]] for x in timesteps]
     else:
-        timesteps_str = [str(x).zfill(3) for x in timesteps.tolist()]
-        files = [os.path.join(main,prefix+x+suffix) for x in timesteps_str]
+        # Get file paths for all timesteps
+        prefix = kind+'-'
+        suffix = '.pvtu'
+        files = [os.path.join(directory,prefix+str(x).zfill(5)+suffix) 
+                 for x in timesteps]
     
+    if single:
+        files = files[0]
 
     return(files)
 
@@ -373,7 +883,8 @@ def particle_positions(meshes,timestep,bounds=None):
     
     Parameters
     ----------
-    meshes: MultiBlock object from load_particle_meshes
+    meshes: MultiBlock object from load_particle_meshes, or particle store 
+        opened with particle_store.open_store.
     timestep: Timestep from which to pull positions.
     
     Returns
@@ -382,20 +893,79 @@ def particle_positions(meshes,timestep,bounds=None):
     positions: NumPy array of particle positions (X,Y,Z)
     """
 
+    if isinstance(meshes,dict):
+        return(particle_store.store_positions(meshes,timestep,bounds))
+
     mesh = meshes[timestep]
     
-    if bounds is not None:
-        mesh = mesh.clip_box(bounds=bounds,invert=False)
+    inside = select_box(mesh,bounds)
     
-    ids = pv.point_array(mesh,'id')
-    positions = pv.point_array(mesh,'position')
+    ids = pv.point_array(mesh,'id')[inside]
+    positions = pv.point_array(mesh,'position')[inside]
     return(ids,positions)
 
-def load_particle_meshes(directory,timesteps,filename='meshes.vtm',bounds=None):
+def decimate_particles(mesh,bins=256,per_bin=4,keep_ids=None,fields=None,
+                       seed=0):
+    """
+    Decimate a dense particle cloud for plotting, keeping at most per_bin 
+    randomly chosen particles in each bin of a uniform grid. Dense regions 
+    are thinned while sparse regions keep all their particles, so the 
+    plotted density stays representative.
+    
+    Parameters
+    ----------
+    mesh: Pyvista mesh of particles, e.g. one block of load_particle_meshes.
+    bins: Number of bins along the longest side of the particle cloud. The
+        bins are square (cubic in 3D). The default is 256.
+    per_bin: Number of particles to keep per bin. The default is 4.
+    keep_ids: NumPy array of particle ids that are always kept, e.g. traced 
+        particles. The default is None.
+    fields: List of particle properties to keep. The default is None, which 
+        keeps only the id.
+    seed: Seed of the random choice of particles, so that repeated plots 
+        show the same particles. The default is 0.
+    
+    Returns
+    -------
+    decimated: Pyvista PolyData with float32 points and properties.
+    """
+    
+    points = np.asarray(mesh.points)
+    lower = points.min(axis=0) if len(points) > 0 else np.zeros(3)
+    extent = np.ptp(points,axis=0) if len(points) > 0 else np.zeros(3)
+    bin_size = max(extent.max()/bins,np.finfo(float).tiny)
+    
+    # Bin of each particle, and a random rank of the particles in each bin
+    cells = np.minimum((points-lower)//bin_size,bins-1).astype(np.int64)
+    shape = np.maximum(cells.max(axis=0,initial=0)+1,1)
+    bin_index = np.ravel_multi_index(cells.T,shape)
+    shuffled = np.random.default_rng(seed).permutation(len(points))
+    order = shuffled[np.argsort(bin_index[shuffled],kind='stable')]
+    sorted_bins = bin_index[order]
+    starts = np.searchsorted(sorted_bins,sorted_bins)
+    
+    keep = np.zeros(len(points),dtype=bool)
+    keep[order[np.arange(len(points))-starts < per_bin]] = True
+    ids = pv.point_array(mesh,'id')
+    if keep_ids is not None:
+        keep |= np.isin(ids,keep_ids)
+    
+    decimated = pv.PolyData(points[keep].astype(np.float32))
+    decimated['id'] = np.asarray(ids)[keep]
+    if fields is not None:
+        for field in fields:
+            decimated[field] = np.asarray(pv.point_array(mesh,field))[keep]\
+                .astype(np.float32)
+    return(decimated)
+
+def load_particle_meshes(directory,timesteps,filename='meshes.vtm',bounds=None,
+                         processes=None,arrays=None):
     """
     Load particle meshes, clip, and save to avoid duplicate computation. This is
     computationally intensive for large meshes and may be preferred to do on 
-    Stampede2.
+    Stampede2. The VTU pieces of all timesteps are read and clipped in a 
+    process pool, and clipped meshes are kept in the mesh cache (see
+    mesh_cache.py) so that only new or changed timesteps are read again.
     
     Parameters
     ----------
@@ -403,6 +973,10 @@ def load_particle_meshes(directory,timesteps,filename='meshes.vtm',bounds=None):
     timesteps: Integer or NumPy array of timesteps to pull.
     filename: Name of file to save clipped meshes to.
     bounds: Bounds by which to clip the model box
+    processes: Number of worker processes used to read the files. The
+        default is None, which uses the number of CPUs.
+    arrays: List of particle properties to read. The default is None, which
+        reads all properties.
     
     Returns
     -------
@@ -414,17 +988,15 @@ def load_particle_meshes(directory,timesteps,filename='meshes.vtm',bounds=None):
     
     # Set up directory building blocks
     files=get_pvtu(directory,timesteps,kind='particles')
+    if isinstance(files,str):
+        files = [files]
     
     # Setup multiblock
     meshes = pv.MultiBlock()
     
-    for file in tqdm(files):
-        mesh = pv.read(file) # Major computation to load this.
-    
-        # Clip mesh to save space
-        if bounds is not None:
-            mesh = mesh.clip_box(bounds=bounds,invert=False)
-        
+    # Major computation to load these, clip meshes to save space
+    for mesh in mesh_cache.load_meshes(files,bounds=bounds,arrays=arrays,
+                                       processes=processes):
         meshes.append(mesh)
         
     # Save clipped meshes as smaller file to work with
@@ -434,6 +1006,70 @@ def load_particle_meshes(directory,timesteps,filename='meshes.vtm',bounds=None):
     print(datetime.now()-startTime)
     
     return(meshes)
-        
-        
-        
+
+
+def iter_meshes(files,bounds=None,arrays=None,prefetch=1,processes=1,
+                cache=False,reuse_geometry=False):
+    """
+    Iterate over the meshes of a series of VTU/PVTU files one timestep at a 
+    time. While a mesh is used, the next meshes are read on a background 
+    thread. Only the current and the prefetched meshes are held in memory, 
+    so reductions over long series run in constant memory.
+    
+    Parameters
+    ----------
+    files: List of paths to VTU or PVTU files, e.g. from get_pvtu.
+    bounds: Bounds by which to clip the meshes [xmin,xmax,ymin,ymax,zmin,zmax].
+        The default is None.
+    arrays: List of point arrays to read. The default is None, which reads
+        all arrays.
+    prefetch: Number of meshes to read ahead, 0 to read each mesh only 
+        when the previous one is done. The default is 1.
+    processes: Number of worker processes used to read the pieces of each 
+        file. The default is 1, which reads them on the background thread.
+    cache: Whether to load the meshes through the mesh cache, see 
+        mesh_cache.py. The default is False.
+    reuse_geometry: Whether to reuse the points and cells of the previous
+        timestep when they have not changed, see vtk_io.read_series. Not
+        used together with cache or processes. The default is False.
+    
+    Yields
+    ------
+    mesh: Pyvista mesh for each file, in order.
+    """
+    
+    # The single background thread reads the files in order, so it can
+    # step through the series generator
+    series = vtk_io.read_series(files,arrays=arrays,progress=False)
+    
+    def read(file):
+        if reuse_geometry and not cache and processes == 1:
+            mesh = next(series)
+            if bounds is not None:
+                mesh = mesh.clip_box(bounds=bounds,invert=False)
+            return(mesh)
+        if cache:
+            return(mesh_cache.load_mesh(file,bounds=bounds,arrays=arrays,
+                                        processes=processes,progress=False))
+        return(vtk_io.read_pvtu_parallel(file,bounds=bounds,
+                                         processes=processes,arrays=arrays,
+                                         progress=False))
+    
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        futures = deque(executor.submit(read,file) 
+                        for file in files[:max(prefetch,1)])
+        n_submitted = len(futures)
+        for _ in tqdm(range(len(files))):
+            mesh = futures.popleft().result()
+            
+            # Start reading the next file before handing out this one, so 
+            # that the current and prefetch meshes are in memory
+            if prefetch > 0 and n_submitted < len(files):
+                futures.append(executor.submit(read,files[n_submitted]))
+                n_submitted += 1
+            
+            yield mesh
+            
+            if prefetch == 0 and n_submitted < len(files):
+                futures.append(executor.submit(read,files[n_submitted]))
+                n_submitted += 1
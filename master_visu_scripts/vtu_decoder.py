@@ -0,0 +1,300 @@
+"""
+Decoder for the data arrays of VTU files in the VTK XML format.
+
+Only the arrays that are asked for are decoded (and decompressed), and the
+encoded points and cells can be hashed without decoding them. This is used
+by vtk_io.read_series to reuse the geometry of a series of output steps.
+
+Inline ascii and base64 arrays and appended raw and base64 arrays are
+supported, with or without zlib compression. Other files raise a ValueError,
+so that callers can fall back to the VTK reader.
+"""
+import re
+import zlib
+import base64
+import hashlib
+
+import numpy as np
+
+TYPES = {'Int8':np.int8,'UInt8':np.uint8,'Int16':np.int16,'UInt16':np.uint16,
+         'Int32':np.int32,'UInt32':np.uint32,'Int64':np.int64,
+         'UInt64':np.uint64,'Float32':np.float32,'Float64':np.float64}
+
+SECTIONS = ['PointData','CellData','Points','Cells']
+
+
+def _attributes(tag):
+    """
+    Get the attributes of an XML tag as a dictionary.
+    """
+    if isinstance(tag,bytes):
+        tag = tag.decode('latin-1')
+    return(dict(re.findall(r'([\w:]+)="([^"]*)"',tag)))
+
+
+def _base64_length(n_bytes):
+    """
+    Number of base64 characters that encode n_bytes bytes.
+    """
+    return(-(-n_bytes//3)*4)
+
+
+def _find_element(data,name,start,end):
+    """
+    Find the first element with a tag name in data[start:end].
+
+    Returns
+    -------
+    element: Tuple of the attributes of the tag, the start and end of the
+        content (equal for empty elements) and the end of the element, or
+        None if there is no such element.
+    """
+    position = start
+    while True:
+        position = data.find(b'<'+name,position,end)
+        if position < 0:
+            return(None)
+        # Skip longer names with the same start, e.g. PointData for Points
+        if data[position+len(name)+1:position+len(name)+2] in b' \t\r\n/>':
+            break
+        position += 1
+    tag_end = data.index(b'>',position)+1
+    attributes = _attributes(data[position+len(name)+1:tag_end-1])
+    if data[tag_end-2:tag_end-1] == b'/':
+        return(attributes,tag_end,tag_end,tag_end)
+    close = data.index(b'</'+name+b'>',tag_end)
+    return(attributes,tag_end,close,close+len(name)+3)
+
+
+def parse_vtu(file):
+    """
+    Parse the XML structure of a VTU file without decoding its arrays.
+
+    Parameters
+    ----------
+    file: Path to VTU file.
+
+    Returns
+    -------
+    layout: Dictionary with the file 'data', the byte order, header type and
+        compressor, the number of points and cells, and for each of the
+        sections 'PointData', 'CellData', 'Points' and 'Cells' a dictionary
+        of the attributes and encoded data of its arrays.
+    """
+    with open(file,'rb') as f:
+        data = f.read()
+
+    # Appended raw data is not valid XML, so only search the part before it
+    appended = data.find(b'<AppendedData')
+    end = len(data) if appended < 0 else appended
+
+    vtkfile = _find_element(data,b'VTKFile',0,end)
+    if vtkfile is None or vtkfile[0].get('type') != 'UnstructuredGrid':
+        raise ValueError(file+" is not an unstructured grid")
+    vtkfile = vtkfile[0]
+    compressor = vtkfile.get('compressor')
+    if compressor not in [None,'vtkZLibDataCompressor']:
+        raise ValueError("Unsupported compressor "+compressor)
+    piece = _find_element(data,b'Piece',0,end)
+    if piece is None or _find_element(data,b'Piece',piece[3],end) is not None:
+        raise ValueError(file+" does not contain exactly one piece")
+
+    layout = dict(file=file,data=data,
+                  byte_order='<' if vtkfile.get('byte_order',
+                                                'LittleEndian')
+                  == 'LittleEndian' else '>',
+                  header_type=vtkfile.get('header_type','UInt32'),
+                  compressor=compressor,
+                  n_points=int(piece[0]['NumberOfPoints']),
+                  n_cells=int(piece[0]['NumberOfCells']),
+                  appended=None,encoding=None)
+
+    offsets = []
+    for section in SECTIONS:
+        layout[section] = {}
+        element = _find_element(data,section.encode(),piece[1],piece[2])
+        if element is None:
+            continue
+        position = element[1]
+        while True:
+            array = _find_element(data,b'DataArray',position,element[2])
+            if array is None:
+                break
+            attributes,begin,stop,position = array
+            content = data[begin:stop]
+            # Leave out nested elements such as InformationKey
+            if b'<' in content:
+                content = re.sub(rb'<(\w+)[^>]*?(?:/>|>.*?</\1>)',b'',content,
+                                 flags=re.S)
+            attributes['text'] = content.strip()
+            layout[section][attributes.get('Name',section)] = attributes
+            if attributes.get('format') == 'appended':
+                offsets.append(int(attributes['offset']))
+
+    if appended >= 0:
+        tag_end = data.index(b'>',appended)+1
+        layout['encoding'] = _attributes(data[appended:tag_end]).get(
+            'encoding','raw')
+        layout['appended'] = data.index(b'_',tag_end)+1
+        # Extent of each appended array, used for hashing
+        offsets = sorted(set(offsets))+[data.rfind(b'</AppendedData>')
+                                        -layout['appended']]
+        for section in SECTIONS:
+            for attributes in layout[section].values():
+                if attributes.get('format') == 'appended':
+                    offset = int(attributes['offset'])
+                    attributes['end'] = offsets[offsets.index(offset)+1]
+
+    return(layout)
+
+
+def _encoded(layout,attributes):
+    """
+    Encoded bytes of an array, as stored in the file.
+    """
+    if attributes.get('format') == 'appended':
+        start = layout['appended']
+        return(layout['data'][start+int(attributes['offset']):
+                              start+attributes['end']])
+    return(attributes['text'])
+
+
+def geometry_signature(layout):
+    """
+    Hash the encoded points and cells of a parsed VTU file. Files with the
+    same signature have the same geometry, files with the same geometry
+    written by the same writer have the same signature.
+
+    Returns
+    -------
+    signature: Hexadecimal SHA-1 digest.
+    """
+    digest = hashlib.sha1()
+    digest.update(str((layout['n_points'],layout['n_cells'])).encode())
+    for section in ['Points','Cells']:
+        for name in sorted(layout[section]):
+            digest.update(name.encode())
+            digest.update(_encoded(layout,layout[section][name]))
+    return(digest.hexdigest())
+
+
+def _decode_blocks(buffer,position,header_type,compressed):
+    """
+    Decode binary data with a VTK header starting at position in buffer.
+    """
+    n = header_type.itemsize
+    if not compressed:
+        size = int(np.frombuffer(buffer,header_type,1,position)[0])
+        return(buffer[position+n:position+n+size])
+
+    n_blocks = int(np.frombuffer(buffer,header_type,1,position)[0])
+    header = np.frombuffer(buffer,header_type,3+n_blocks,position)
+    start = position+(3+n_blocks)*n
+    blocks = []
+    for size in header[3:].astype(np.int64):
+        blocks.append(zlib.decompress(buffer[start:start+size]))
+        start += size
+    return(b''.join(blocks))
+
+
+def _decode_base64(text,header_type,compressed):
+    """
+    Decode base64 data with a VTK header. The header may be encoded
+    separately from the data, which VTK always does for compressed data.
+    """
+    n = header_type.itemsize
+    if compressed:
+        first = base64.b64decode(text[:_base64_length(n)])
+        n_blocks = int(np.frombuffer(first,header_type,1)[0])
+        length = _base64_length((3+n_blocks)*n)
+        header = base64.b64decode(text[:length])
+        return(_decode_blocks(header+base64.b64decode(text[length:]),0,
+                              header_type,True))
+
+    length = _base64_length(n)
+    if text[length-1:length] == b'=':
+        header = base64.b64decode(text[:length])[:n]
+        return(_decode_blocks(header+base64.b64decode(text[length:]),0,
+                              header_type,False))
+    return(_decode_blocks(base64.b64decode(text),0,header_type,False))
+
+
+def decode_array(layout,section,name):
+    """
+    Decode one array of a parsed VTU file.
+
+    Parameters
+    ----------
+    layout: Parsed file from parse_vtu.
+    section: 'PointData', 'CellData', 'Points' or 'Cells'.
+    name: Name of the array, e.g. 'T', or 'connectivity', 'offsets' and
+        'types' for the cells.
+
+    Returns
+    -------
+    array: NumPy array of shape (values,) or (values,components).
+    """
+    attributes = layout[section][name]
+    dtype = np.dtype(TYPES[attributes['type']]).newbyteorder(
+        layout['byte_order'])
+    header_type = np.dtype(TYPES[layout['header_type']]).newbyteorder(
+        layout['byte_order'])
+    compressed = layout['compressor'] is not None
+    form = attributes.get('format')
+
+    if form == 'ascii':
+        array = np.array(attributes['text'].split(),dtype=dtype)
+    else:
+        if form == 'binary':
+            raw = _decode_base64(attributes['text'],header_type,compressed)
+        elif form == 'appended' and layout['encoding'] == 'raw':
+            raw = _decode_blocks(layout['data'],
+                                 layout['appended']+int(attributes['offset']),
+                                 header_type,compressed)
+        elif form == 'appended':
+            raw = _decode_base64(_encoded(layout,attributes).strip(),
+                                 header_type,compressed)
+        else:
+            raise ValueError("Unsupported format "+str(form))
+        array = np.frombuffer(raw,dtype)
+
+    components = int(attributes.get('NumberOfComponents',1))
+    array = array.astype(dtype.newbyteorder('='),copy=False)
+    if components > 1:
+        array = array.reshape(-1,components)
+    return(array)
+
+
+def read_piece(layout,arrays=None,geometry=True):
+    """
+    Decode a parsed VTU file into the arrays used by vtk_io.arrays_to_mesh.
+
+    Parameters
+    ----------
+    layout: Parsed file from parse_vtu.
+    arrays: List of point arrays to decode. The default is None, which
+        decodes all point arrays.
+    geometry: Whether to decode the points and cells. The default is True.
+
+    Returns
+    -------
+    piece: Dictionary with points, connectivity, offsets and celltypes (None
+        if geometry is False) and a dictionary of point_data.
+    """
+    if arrays is None:
+        arrays = list(layout['PointData'])
+    point_data = {name:decode_array(layout,'PointData',name)
+                  for name in arrays if name in layout['PointData']}
+
+    piece = dict(points=None,connectivity=None,offsets=None,celltypes=None,
+                 point_data=point_data)
+    if geometry:
+        points = decode_array(layout,'Points',
+                              list(layout['Points'])[0])
+        piece['points'] = points.reshape(layout['n_points'],3)
+        piece['connectivity'] = decode_array(layout,'Cells','connectivity')
+        # VTU offsets are the ends of the cells
+        piece['offsets'] = np.concatenate(
+            [[0],decode_array(layout,'Cells','offsets')])
+        piece['celltypes'] = decode_array(layout,'Cells','types')
+    return(piece)